@@ -0,0 +1,23 @@
+from typing import Any
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+def json_default(value: Any) -> Any:
+    """Encode the types orjson doesn't know"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, BaseModel):
+        return value.dict(by_alias=True)
+    raise TypeError(f"Type {type(value).__name__} is not JSON serializable")
+
+
+class FastJSONResponse(ORJSONResponse):
+    """JSON response encoded with orjson. Returning it directly skips the response model validation, its content
+    must already have the shape of the documented response model"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
@@ -1,18 +1,35 @@
-from fastapi import APIRouter, HTTPException
-from starlette.responses import Response
+import io
+from typing import BinaryIO, Tuple
+
+from fastapi import APIRouter, HTTPException, Query
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
 from websockets.exceptions import ConnectionClosedOK
 
-from fastapi.websockets import WebSocket
+from fastapi.websockets import WebSocket, WebSocketDisconnect
 
+from app.enums.batch_format import BatchFormat
+from app.enums.image_format import ImageFormat
 from app.model.file_model import ResponseFileModel, FileModel, UpdateFileModel
+from app.model.library_model import LibraryModel
+from app.model.rendition_model import RenditionModel
+from app.services.batch_service import BatchService
 from app.services.db_service import db_find_file, db_find_library_by_name, db_delete_file, db_find_file_by_full_path, \
     db_update_file
 from app.services.directory_service import DirectoryService
 from app.services.file_service import FileService
+from app.services.image_service import ImageService
+from app.services.page_cache_service import PageCache
+from app.services.push_service import PushSession
+from app.services.rendition_service import RenditionService
 from app.services.storage_service import StorageService
+from app.services.thumbnail_service import ThumbnailService
 
 router = APIRouter(prefix="/file", tags=["File"], responses={404: {"file": "Not found"}})
 
+# Browser cache duration of the pages and covers requested without version
+CACHE_MAX_AGE = 3600
+
 
 async def get_library_file(library_name: str, file_id: str):
     """Get the library and file objects in database based on their identifiers or return the proper error"""
@@ -24,70 +41,207 @@ async def get_library_file(library_name: str, file_id: str):
     if not file:
         raise HTTPException(status_code=404, detail="File not found in database")
 
-    if not StorageService(library).isfile(file.full_path):
+    storage = StorageService(library)
+    if not await storage.run(storage.isfile, file.full_path):
         raise HTTPException(status_code=404, detail="File not found on storage")
 
     return library, file
 
 
-def format_file_response(file: FileModel, image_bytes: bytes):
-    image_format = file.pages_names[0].split('.')[-1]
-    headers = {"Content-Disposition": f"inline; filename=\"{file.id}-0.{image_format}\""}
-    return Response(content=image_bytes, media_type=f"image/{image_format}", headers=headers)
+async def page_format(library: LibraryModel, file: FileModel, num: int, stream: BinaryIO) -> str:
+    """Format of a page for its media type, the cached pages are recognized from their content so their file pages
+    manifest isn't loaded"""
+    if isinstance(stream, io.BytesIO) and (image_format := ImageFormat.from_content(stream.getbuffer()[:12].tobytes())):
+        return image_format.value
+    await FileService.load_pages(library, file)
+    return file.pages_names[num].split('.')[-1]
+
+
+def format_stream_response(request: Request, library: LibraryModel, file: FileModel, stream: BinaryIO, size: int,
+                           image_format: str, headers: dict = None) -> Response:
+    """Stream a page, a single bytes range can be requested with the Range header to resume a download"""
+    headers = {"Content-Disposition": f"inline; filename=\"{file.id}-0.{image_format}\"", "Accept-Ranges": "bytes",
+               **(headers or {})}
+    start, length, status_code = 0, size, 200
+    # A Range is ignored if the client copy is outdated according to If-Range
+    if (range_header := request.headers.get("range")) is not None \
+            and request.headers.get("if-range", headers.get("ETag")) == headers.get("ETag"):
+        if (byte_range := parse_range(range_header, size)) is None:
+            stream.close()
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        if byte_range != (0, size - 1):
+            start, length, status_code = byte_range[0], byte_range[1] - byte_range[0] + 1, 206
+            headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
+    headers["Content-Length"] = str(length)
+    return StreamingResponse(FileService.iter_stream(library, stream, start, length), status_code=status_code,
+                             media_type=f"image/{image_format}", headers=headers)
+
+
+def parse_range(range_header: str, size: int) -> Tuple[int, int] | None:
+    """First and last byte positions of a single range Range header, multiple ranges are served as the whole
+    content. Return None if the range can't be satisfied"""
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in ranges:
+        return 0, size - 1
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if not first:
+            # Suffix range, the last bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return 0, size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+def cache_headers(etag: str, file: FileModel, version: str | None) -> dict:
+    """Validators and cache policy of a page or cover, the content of a file id only changes with its md5 so the
+    URLs versioned with the current md5 are immutable"""
+    if version == file.md5:
+        return {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    return {"ETag": etag, "Cache-Control": f"public, max-age={CACHE_MAX_AGE}"}
+
+
+def read_headers(file: FileModel) -> dict:
+    """The read URLs serve a different page after each move, they must always be revalidated"""
+    return {"ETag": page_etag(file, file.current_page), "Cache-Control": "no-cache"}
+
+
+def page_etag(file: FileModel, page_number: int, rendition: RenditionModel = None) -> str:
+    if rendition is not None:
+        return f'"{rendition.cache_name(file.md5, page_number)}"'
+    return f'"{file.md5}-{page_number}"'
+
+
+def not_modified(request: Request, headers: dict) -> Response | None:
+    """Empty 304 response if the client already has the current version of the content"""
+    if (if_none_match := request.headers.get("if-none-match")) is None:
+        return None
+    etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+    if "*" in etags or headers["ETag"] in etags:
+        return Response(status_code=304, headers=headers)
+    return None
 
 
 @router.get("/{library_name}/{file_id}/cover", response_class=Response)
-async def get_cover(library_name: str, file_id: str) -> Response:
-    """Get the cover/first page of a file"""
+async def get_cover(request: Request, library_name: str, file_id: str, v: str | None = None) -> Response:
+    """Get the cover/first page of a file, `v` can be set to the file md5 to make the response immutable"""
     library, file = await get_library_file(library_name, file_id)
     storage_service = StorageService(library)
-    if storage_service.thumbnail_exist(file):
-        thumbnail_response = storage_service.get_thumbnail(file)
+    if await storage_service.run(storage_service.thumbnail_exist, file):
+        headers = cache_headers(f'"{file.md5}-cover-{ImageService.THUMBNAIL_VERSION}"', file, v)
+        if (response := not_modified(request, headers)) is not None:
+            return response
+        thumbnail_response = await storage_service.run(storage_service.get_thumbnail, file)
+        thumbnail_response.headers.update(headers)
         return thumbnail_response
-    raise HTTPException(status_code=404, detail="No cover for this file")
+    ThumbnailService.enqueue(library, file)
+    raise HTTPException(status_code=404, detail="No cover for this file yet, its generation is pending")
 
 
 @router.get("/{library_name}/{file_id}/page/{page_number}", response_class=Response)
-async def get_page(library_name: str, file_id: str, page_number: int):
-    """Get page of a file"""
+async def get_page(request: Request, library_name: str, file_id: str, page_number: int,
+                   width: int | None = Query(None, ge=16, le=8192), quality: int | None = Query(None, ge=1, le=100),
+                   format: ImageFormat | None = None, v: str | None = None):
+    """Get page of a file, when a width, quality or format is given the page is scaled down to the width and
+    re-encoded. `v` can be set to the file md5 to make the response immutable"""
     library, file = await get_library_file(library_name, file_id)
     if page_number not in range(0, file.pages_count):
         raise HTTPException(status_code=404, detail="Page not found in file")
-    return format_file_response(file, FileService.get_page(library, file, page_number))
+    rendition = RenditionModel(width=width, quality=quality, format=format)
+    if rendition.is_original():
+        headers = cache_headers(page_etag(file, page_number), file, v)
+        if (response := not_modified(request, headers)) is not None:
+            return response
+        stream, size = await FileService.open_page(library, file, page_number)
+        return format_stream_response(request, library, file, stream, size,
+                                      await page_format(library, file, page_number, stream), headers)
+    page_name = None
+    if rendition.format is None:
+        # The format of the original page is kept
+        page_name = (await FileService.load_pages(library, file)).pages_names[page_number]
+    rendition = rendition.resolve(page_name)
+    headers = cache_headers(page_etag(file, page_number, rendition), file, v)
+    if (response := not_modified(request, headers)) is not None:
+        return response
+    content = await RenditionService.get_page(library, file, page_number, rendition)
+    return format_stream_response(request, library, file, io.BytesIO(content), len(content), rendition.format.value,
+                                  headers)
 
 
-@router.post("/{library_name}/{file_id}/page/{page_number}", response_model=ResponseFileModel)
-async def set_current_page(library_name: str, file_id: str, page_number: int):
+@router.get("/{library_name}/{file_id}/pages", response_class=Response)
+async def get_pages(request: Request, library_name: str, file_id: str, start: int = Query(0, ge=0),
+                    end: int | None = Query(None, ge=0), format: BatchFormat = BatchFormat.ZIP, v: str | None = None):
+    """Get the pages `start` to `end` (included, last page by default) of a file in a single streamed zip or
+    multipart response, the file is opened once and its pages read in order. `v` can be set to the file md5 to make
+    the response immutable. The batches of files without pages index are only checked against BATCH_MAX_MB while
+    streamed, when over it the batch ends with a `truncated` entry or part holding the number of the first page left
+    out"""
     library, file = await get_library_file(library_name, file_id)
-    if page_number not in range(0, file.pages_count):
-        raise HTTPException(status_code=404, detail="Page not found in file")
-    return await FileService.set_page(library, file, page_number)
+    await FileService.load_pages(library, file)
+    end = file.pages_count - 1 if end is None else min(end, file.pages_count - 1)
+    if start > end:
+        raise HTTPException(status_code=404, detail="Pages not found in file")
+    nums = list(range(start, end + 1))
+    if len(nums) > BatchService.MAX_PAGES:
+        raise HTTPException(status_code=413, detail=f"A batch is limited to {BatchService.MAX_PAGES} pages")
+    if (size := BatchService.indexed_size(file, nums)) is None:
+        # The batch of an unindexed file may be truncated while streamed, it can't be validated nor cached
+        headers = {"Cache-Control": "no-store"}
+    elif size > BatchService.MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"A batch is limited to {BatchService.MAX_BYTES} bytes")
+    else:
+        headers = cache_headers(f'"{file.md5}-{start}-{end}-{format.value}"', file, v)
+        if (response := not_modified(request, headers)) is not None:
+            return response
+    boundary = BatchService.new_boundary()
+    headers["Content-Disposition"] = f"inline; filename=\"{file.id}-{start}-{end}.{format.value}\""
+    pages = FileService.iter_pages(library, file, nums)
+    return StreamingResponse(BatchService.encode(file, pages, format, boundary),
+                             media_type=BatchService.media_type(format, boundary), headers=headers)
 
 
-@router.get("/{library_name}/{file_id}/read/{page_number}", response_class=Response)
-async def read_page(library_name: str, file_id: str, page_number: int):
-    """Get page of a file and set it as the current page for the file"""
+@router.post("/{library_name}/{file_id}/page/{page_number}", response_model=ResponseFileModel)
+async def set_current_page(library_name: str, file_id: str, page_number: int):
     library, file = await get_library_file(library_name, file_id)
     if page_number not in range(0, file.pages_count):
         raise HTTPException(status_code=404, detail="Page not found in file")
-    file = await FileService.set_page(library, file, page_number)
-    return format_file_response(file, FileService.get_current_page(library, file))
+    return await FileService.set_page(library, file, page_number)
 
 
 @router.get("/{library_name}/{file_id}/read/next", response_class=Response)
-async def read_next(library_name: str, file_id: str):
+async def read_next(request: Request, library_name: str, file_id: str):
     """Get the next page of a file and set it as the current page for the file"""
     library, file = await get_library_file(library_name, file_id)
     file = await FileService.next_page(library, file)
-    return format_file_response(file, FileService.get_current_page(library, file))
+    stream, size = await FileService.open_page(library, file, file.current_page)
+    return format_stream_response(request, library, file, stream, size,
+                                  await page_format(library, file, file.current_page, stream), read_headers(file))
 
 
 @router.get("/{library_name}/{file_id}/read/prev", response_class=Response)
-async def read_previous(library_name: str, file_id: str):
+async def read_previous(request: Request, library_name: str, file_id: str):
     """Get the previous page of a file and set it as the current page for the file"""
     library, file = await get_library_file(library_name, file_id)
-    file = await FileService.next_page(library, file)
-    return format_file_response(file, FileService.get_current_page(library, file))
+    file = await FileService.prev_page(library, file)
+    stream, size = await FileService.open_page(library, file, file.current_page)
+    return format_stream_response(request, library, file, stream, size,
+                                  await page_format(library, file, file.current_page, stream), read_headers(file))
+
+
+@router.get("/{library_name}/{file_id}/read/{page_number}", response_class=Response)
+async def read_page(request: Request, library_name: str, file_id: str, page_number: int):
+    """Get page of a file and set it as the current page for the file"""
+    library, file = await get_library_file(library_name, file_id)
+    if page_number not in range(0, file.pages_count):
+        raise HTTPException(status_code=404, detail="Page not found in file")
+    file = await FileService.set_page(library, file, page_number)
+    stream, size = await FileService.open_page(library, file, file.current_page)
+    return format_stream_response(request, library, file, stream, size,
+                                  await page_format(library, file, file.current_page, stream), read_headers(file))
 
 
 @router.post("/{library_name}/{file_id}/regen", response_model=ResponseFileModel)
@@ -97,35 +251,45 @@ async def regenerate_file_data(library_name: str, file_id: str):
     Thumbnail is also regenerated.
     """
     library, file = await get_library_file(library_name, file_id)
-    StorageService(library).delete_thumbnail(file)
+    storage = StorageService(library)
+    await storage.run(storage.delete_thumbnail, file)
+    PageCache.invalidate(file.md5)
     await db_delete_file(library.name, str(file.id))
     await DirectoryService.get_dir_content(library, file.path, True)  # Regenerate file in db and thumbnail
     new_file = await db_find_file_by_full_path(library.name, file.full_path)
-    return await db_update_file(library.name, str(new_file.id), UpdateFileModel(
+    new_file = await db_update_file(library.name, str(new_file.id), UpdateFileModel(
         current_page=file.current_page, add_date=file.add_date, update_date=file.update_date))
+    # The file got a new id which might be the first child of its directories
+    await DirectoryService.refresh_directories(library, [file.path])
+    return new_file
 
 
 @router.websocket("/")
-async def stream_file(websocket: WebSocket, library_name: str, file_id: str):
+async def stream_file(websocket: WebSocket, library_name: str, file_id: str, push: bool = False,
+                      resume: int | None = None, credits: int | None = None):
     """Open a new websocket on a file streaming one page at  the time, to control it use:
         + : next page
         - : previous page
-        any number : jump top page number (if exist)"""
-    resume_token = None  # TODO Manage resume on error
+        any number : jump top page number (if exist)
+    With `push` the next pages are sent ahead as binary frames prefixed by their index, see PushSession. A reconnecting
+    client sets `resume` to the first page it is missing and `credits` to the number of pages it can receive"""
     try:
         await websocket.accept()
-        library, file = get_library_file(library_name, file_id)
+        library, file = await get_library_file(library_name, file_id)
+        if push:
+            await PushSession(websocket, library, file, resume, credits).run()
+            return
 
         # Send current page then await command, execute command then send current page
         await websocket.send_json(ResponseFileModel(**file.dict()).json())
-        await websocket.send_bytes(FileService.get_current_page(library, file))
+        await websocket.send_bytes(await FileService.get_current_page(library, file))
         while True:
             action = await websocket.receive_text()
             file = await FileService.execute_action(library, file, action)
             await websocket.send_json(ResponseFileModel(**file.dict()).json())
-            await websocket.send_bytes(FileService.get_current_page(library, file))
+            await websocket.send_bytes(await FileService.get_current_page(library, file))
 
-    except ConnectionClosedOK:
+    except (ConnectionClosedOK, WebSocketDisconnect):
         pass
     except Exception as e:
         print(e)
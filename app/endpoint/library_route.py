@@ -1,19 +1,24 @@
 import logging
 from typing import List
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query
 from fastapi import status
 
 from app.endpoint.base_models.custom_response_models import LibContentResponseModel, LibraryResponseModel
+from app.endpoint.base_models.fast_json_response import FastJSONResponse
 from app.model.file_model import ResponseFileModel
 
 from app.model.library_model import UpdateLibraryModel, LibraryModel
+from app.model.scan_report_model import ScanReportModel
 from app.services.db_service import db_find_all_libraries, db_find_library_by_name, db_insert_library, \
     db_delete_library, db_update_library, db_remove_collection, db_find_last_ongoing, db_find_last_added, \
-    db_find_last_added_by_days
+    db_find_last_added_by_days, directories_collection, pages_collection
 from app.services.directory_service import DirectoryService
 from app.services.file_service import FileService
+from app.services.index_service import IndexService
 from app.services.library_service import create_library_model
+from app.services.smb_pool import SmbConnectionPool
+from app.services.thumbnail_manifest_service import ThumbnailManifest
 
 router = APIRouter(prefix="/library", tags=["Library"], responses={404: {"library": "Not found"}})
 LOGGER = logging.getLogger(__name__)
@@ -40,6 +45,7 @@ async def create_library(name: str, path: str, hidden: bool, connect_type: str,
         name=name, path=path, hidden=hidden, connect_type=connect_type, user=user, passsword=password))
     if not creation_result.inserted_id:
         raise HTTPException(status_code=400, detail="Impossible to insert new library")
+    await IndexService.ensure_library_indexes(name)
 
 
 @router.put("/{name}", response_model=LibraryResponseModel)
@@ -47,7 +53,11 @@ async def update_library(name: str, library: UpdateLibraryModel):
     library_from_db = await db_find_library_by_name(name)
 
     if library_from_db is not None:
-        return await db_update_library(str(library_from_db.id), library)
+        updated_library = await db_update_library(str(library_from_db.id), library)
+        # Connections and thumbnails are bound to the previous location
+        SmbConnectionPool.invalidate(name)
+        ThumbnailManifest.invalidate(name)
+        return updated_library
 
     raise HTTPException(status_code=404, detail=f"Library {name} not found")
 
@@ -59,43 +69,69 @@ async def remove_library(name: str):
     if library_from_db is not None:
         await db_delete_library(str(library_from_db.id))
         await db_remove_collection(name)
+        await db_remove_collection(directories_collection(name))
+        await db_remove_collection(pages_collection(name))
+        SmbConnectionPool.invalidate(name)
+        ThumbnailManifest.invalidate(name)
     else:
         raise HTTPException(status_code=404, detail=f"Library {name} not found")
 
 
-@router.get("/{library_name}/content", response_model=LibContentResponseModel)
-async def get_path_content(library_name: str, path: str = ""):
+@router.get("/{library_name}/content", response_model=LibContentResponseModel, response_class=FastJSONResponse)
+async def get_path_content(library_name: str, path: str = "", cursor: str | None = None,
+                           limit: int | None = Query(None, ge=1, le=1000)):
+    """Get the sub-dirs then files of a folder sorted by name, paginated when a `limit` or a `cursor` is given with
+    `limit` defaulting to CONTENT_PAGE_SIZE. When there are more entries the X-Next-Cursor header holds the `cursor`
+    of the next page"""
     library = await db_find_library_by_name(library_name)
     # Remove leading slash or backslash
     if path.startswith("\\") or path.startswith("/"):
         path = path.lstrip(path[0])
     try:
-        result = await DirectoryService.get_dir_content(library, path, generate_thumbnails=True, dir_thumbnail=True)
+        dirs, files, next_cursor = await DirectoryService.get_dir_content_page(library, path, cursor, limit)
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail=f"Folder {path} not found")
-    return result
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor is not None else None
+    content = [[directory.dict() for directory in dirs], [ResponseFileModel.serialize(file) for file in files]]
+    return FastJSONResponse(content, headers=headers)
 
 
-@router.get("/{library_name}/last_ongoing", response_model=List[ResponseFileModel])
+@router.get("/{library_name}/last_ongoing", response_model=List[ResponseFileModel], response_class=FastJSONResponse)
 async def get_last_ongoing_files(library_name: str, limit: int = 10):
-    return await db_find_last_ongoing(library_name, limit)
+    return FastJSONResponse([ResponseFileModel.serialize(file)
+                             for file in await db_find_last_ongoing(library_name, limit)])
 
 
-@router.get("/{library_name}/last_added", response_model=List[ResponseFileModel])
+@router.get("/{library_name}/last_added", response_model=List[ResponseFileModel], response_class=FastJSONResponse)
 async def get_last_added(library_name: str, limit: int = 10):
-    return await db_find_last_added(library_name, limit)
+    return FastJSONResponse([ResponseFileModel.serialize(file)
+                             for file in await db_find_last_added(library_name, limit)])
 
 
-@router.get("/{library_name}/last_added_since", response_model=List[ResponseFileModel])
+@router.get("/{library_name}/last_added_since", response_model=List[ResponseFileModel],
+            response_class=FastJSONResponse)
 async def get_last_since(library_name: str, days: int = 15, limit: int = None):
-    return await db_find_last_added_by_days(library_name, days, limit)
+    return FastJSONResponse([ResponseFileModel.serialize(file)
+                             for file in await db_find_last_added_by_days(library_name, days, limit)])
 
 
-@router.get("/{library_name}/scan")
-async def scan_base_directory(library_name: str, purge: bool = False):
+@router.get("/{library_name}/indexes")
+async def get_library_indexes(library_name: str):
+    """Usage statistics of the indexes of the library collections, missing expected indexes are reported too"""
+    if await db_find_library_by_name(library_name) is None:
+        raise HTTPException(status_code=404, detail=f"Library {library_name} not found")
+    return await IndexService.library_index_stats(library_name)
+
+
+@router.get("/{library_name}/scan", response_model=ScanReportModel)
+async def scan_base_directory(library_name: str, purge: bool = False, incremental: bool = False):
+    """Scan the whole library, with incremental mode the directories unchanged since the last scan are skipped"""
     library = await db_find_library_by_name(library_name)
-    LOGGER.info(f"Starting library {library_name} scan")
-    await DirectoryService.scan_in_depth(library, "")
-    LOGGER.info(f"Scan completed for library {library_name} scan")
-    if purge:
-        await FileService.purge_deleted_files(library)
+    LOGGER.info(f"Starting library {library_name} {'incremental ' if incremental else ''}scan")
+    report = await DirectoryService.scan_in_depth(library, "", incremental=incremental)
+    LOGGER.info(f"Scan completed for library {library_name} scan : {report}")
+    if purge and (purged_paths := await FileService.purge_deleted_files(library)):
+        await DirectoryService.refresh_directories(library, purged_paths)
+    return report
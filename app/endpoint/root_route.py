@@ -1,6 +1,17 @@
 from fastapi import APIRouter
 from fastapi.responses import PlainTextResponse
 
+from app.services.library_cache_service import LibraryCache
+from app.services.page_cache_service import PageCache
+from app.services.prefetch_service import PrefetchService
+from app.services.progress_service import ProgressBuffer
+from app.services.push_service import PushSession
+from app.services.rendition_service import RenditionCache
+from app.services.smb_file import SmbFile
+from app.services.smb_pool import SmbConnectionPool
+from app.services.thumbnail_manifest_service import ThumbnailManifest
+from app.services.thumbnail_service import ThumbnailService
+
 router = APIRouter(tags=["Root"])
 
 
@@ -8,3 +19,20 @@ router = APIRouter(tags=["Root"])
 async def ping():
     """Anyone home?"""
     return 'pong'
+
+
+@router.get("/stats")
+async def stats():
+    """Runtime counters of the storage transfers and caches"""
+    return {
+        "smb": SmbFile.stats(),
+        "smb_pools": SmbConnectionPool.stats(),
+        "page_cache": PageCache.stats(),
+        "prefetch": PrefetchService.stats(),
+        "push": PushSession.stats(),
+        "progress": ProgressBuffer.stats(),
+        "library_cache": LibraryCache.stats(),
+        "thumbnails": ThumbnailManifest.stats(),
+        "thumbnail_queue": ThumbnailService.stats(),
+        "renditions": RenditionCache.stats()
+    }
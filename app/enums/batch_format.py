@@ -0,0 +1,6 @@
+from enum import Enum
+
+
+class BatchFormat(Enum):
+    ZIP = "zip"
+    MULTIPART = "multipart"
@@ -0,0 +1,27 @@
+from enum import Enum
+
+
+class ImageFormat(Enum):
+    JPEG = "jpeg"
+    WEBP = "webp"
+    PNG = "png"
+
+    @staticmethod
+    def from_file_name(name: str) -> "ImageFormat":
+        """Format matching the extension of an image file, images in other formats are re-encoded to JPEG"""
+        extension = name.rsplit(".", 1)[-1].lower()
+        if extension == "jpg":
+            return ImageFormat.JPEG
+        return next((image_format for image_format in ImageFormat if image_format.value == extension),
+                    ImageFormat.JPEG)
+
+    @staticmethod
+    def from_content(content: bytes) -> "ImageFormat | None":
+        """Format of an image according to the signature at its start, None if it isn't one of the formats"""
+        if content.startswith(b"\xff\xd8\xff"):
+            return ImageFormat.JPEG
+        if content.startswith(b"\x89PNG\r\n\x1a\n"):
+            return ImageFormat.PNG
+        if content.startswith(b"RIFF") and content[8:12] == b"WEBP":
+            return ImageFormat.WEBP
+        return None
@@ -4,6 +4,13 @@ from fastapi import FastAPI
 
 from app import loging_config  # noqa: F401
 from app.endpoint import file_route, library_route, root_route
+from app.services.db_service import db_flush_progress
+from app.services.executor_service import ExecutorService
+from app.services.file_service import FileService
+from app.services.index_service import IndexService
+from app.services.progress_service import ProgressBuffer
+from app.services.smb_pool import SmbConnectionPool
+from app.services.thumbnail_service import ThumbnailService
 
 LOGGER = logging.getLogger(__name__)
 
@@ -13,4 +20,23 @@ app.include_router(root_route.router)
 app.include_router(file_route.router)
 app.include_router(library_route.router)
 
+
+@app.on_event("startup")
+async def startup():
+    await IndexService.ensure_all_indexes()
+    await FileService.migrate_pages_manifests()
+    ProgressBuffer.start(db_flush_progress)
+    SmbConnectionPool.start_reaper()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    ProgressBuffer.stop()
+    await db_flush_progress()
+    await ThumbnailService.shutdown()
+    ExecutorService.shutdown()
+    SmbConnectionPool.stop_reaper()
+    SmbConnectionPool.close_all()
+
+
 LOGGER.info("app is running")
\ No newline at end of file
@@ -1,5 +1,6 @@
-from os.path import basename
-from typing import Optional
+from datetime import datetime
+from os.path import basename, dirname
+from typing import Optional, List
 
 from pydantic import BaseModel, Field
 
@@ -11,7 +12,42 @@ class DirectoryModel(BaseModel):
     name: str = Field(...)
     type: str = TypeModel.DIR.value
     thumbnail_id: Optional[str]
+    file_count: Optional[int]
+    total_pages: Optional[int]
+    unread_count: Optional[int]
+    ongoing_count: Optional[int]
 
     @staticmethod
     def create(path: str):
         return DirectoryModel(**{"path": path, "name": basename(path)})
+
+
+class DirectoryCountsModel(BaseModel):
+    """Aggregated data of the files of a directory"""
+    first_child_id: Optional[str]
+    file_count: int = 0
+    total_pages: int = 0
+    unread_count: int = 0
+    ongoing_count: int = 0
+
+
+class DirectoryStateModel(DirectoryCountsModel):
+    """Last scanned state of a directory, used by incremental scans to skip directories whose content didn't change.
+    The inherited counts cover the whole directory tree while `own` only covers the files directly inside it, they're
+    rebuilt by scans and kept up to date by reading progress in between"""
+    path: str = Field(...)
+    parent: Optional[str]
+    mtime: Optional[float]
+    signature: str = Field(...)  # Hash of the files names, sizes and modification times
+    dirs: List[str] = Field(...)
+    scan_date: datetime = Field(...)
+    own: DirectoryCountsModel = DirectoryCountsModel()
+
+    @staticmethod
+    def lineage(path: str) -> List[str]:
+        """The path of a directory and of all its parents up to the library root"""
+        paths = [path]
+        while path:
+            path = dirname(path)
+            paths.append(path)
+        return paths
@@ -9,6 +9,15 @@ from pydantic import BaseModel, Field, validator
 from app.model.py_object_id import PyObjectId
 
 
+class PageOffsetModel(BaseModel):
+    """Location of a page inside a zip archive, used to read it without parsing the central directory"""
+    offset: int = Field(...)  # Local file header offset
+    compress_size: int = Field(...)
+    compress_type: int = Field(...)
+    file_size: int = Field(...)
+    crc: int = Field(...)
+
+
 class FileModel(BaseModel):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     full_path: str = Field(...)
@@ -17,11 +26,18 @@ class FileModel(BaseModel):
     extension: str = Field(...)
     type: str = Field(...)
     pages_count: int = Field(...)
-    pages_names: List[str] = Field(...)
+    # Pages manifest, stored apart and only loaded to serve pages (see FileService.load_pages)
+    pages_names: Optional[List[str]]
+    pages_offsets: Optional[List[PageOffsetModel]]
     current_page: int = Field(...)
     md5: str = Field(...)
+    fingerprint: Optional[str]
+    size: Optional[int]
+    mtime: Optional[float]
     add_date: Optional[datetime]
     update_date: Optional[datetime]
+    # Only set in listings, not stored
+    thumbnail_status: Optional[str]
 
     @validator("path", "full_path")
     def trim_path(cls, value: str):
@@ -29,6 +45,24 @@ class FileModel(BaseModel):
             return value.lstrip(value[0])
         return value
 
+    @classmethod
+    def from_document(cls, document: dict) -> "FileModel":
+        """Build a file from a database document without validation, the documents are written from validated
+        models. Missing fields (projections) get their default value"""
+        values = {name: document[field.alias] for name, field in cls.__fields__.items() if field.alias in document}
+        values["id"] = str(document["_id"])
+        if values.get("pages_offsets") is not None:
+            values["pages_offsets"] = [PageOffsetModel.construct(**offset) for offset in values["pages_offsets"]]
+        return cls.construct(**values)
+
+    def reading_status(self) -> str:
+        """Reading status counted by the directories : unread, ongoing (same rule as the last ongoing query) or read"""
+        if not self.current_page or self.current_page <= 0:
+            return "unread"
+        if self.current_page < self.pages_count - 1:
+            return "ongoing"
+        return "read"
+
     class Config:
         json_encoders = {ObjectId: str}
         # Whether to allow arbitrary user types for fields
@@ -46,8 +80,12 @@ class UpdateFileModel(BaseModel):
     extension: Optional[str]
     pages_count: Optional[int]
     pages_names: Optional[List[str]]
+    pages_offsets: Optional[List[PageOffsetModel]]
     current_page: Optional[int]
     md5: Optional[str]
+    fingerprint: Optional[str]
+    size: Optional[int]
+    mtime: Optional[float]
     add_date: Optional[datetime]
     update_date: Optional[datetime]
 
@@ -77,6 +115,13 @@ class ResponseFileModel(BaseModel):
     current_page: int = Field(...)
     add_date: Optional[datetime]
     update_date: Optional[datetime]
+    thumbnail_status: Optional[str]
+
+    @staticmethod
+    def serialize(file: FileModel) -> dict:
+        """Response fields of a file ready to be encoded in JSON, without building and validating a response model"""
+        return {field.alias: str(file.id) if name == "id" else getattr(file, name)
+                for name, field in ResponseFileModel.__fields__.items()}
 
     class Config:
         json_encoders = {ObjectId: str}
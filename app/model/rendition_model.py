@@ -0,0 +1,27 @@
+from typing import ClassVar, Optional
+
+from pydantic import BaseModel
+
+from app.enums.image_format import ImageFormat
+
+
+class RenditionModel(BaseModel):
+    """Resized and/or re-encoded version of a page, an empty rendition is the original page"""
+    width: Optional[int]
+    quality: Optional[int]
+    format: Optional[ImageFormat]
+
+    DEFAULT_QUALITY: ClassVar[int] = 80
+
+    def is_original(self) -> bool:
+        return self.width is None and self.quality is None and self.format is None
+
+    def resolve(self, page_name: str = None) -> "RenditionModel":
+        """Fill the unset parameters, the format of the original page is kept when none is asked so `page_name` is
+        only needed then"""
+        return RenditionModel(width=self.width, quality=self.quality or self.DEFAULT_QUALITY,
+                              format=self.format or ImageFormat.from_file_name(page_name))
+
+    def cache_name(self, md5: str, num: int) -> str:
+        """Name of the rendition in the renditions cache, only call it on a resolved rendition"""
+        return f"{md5}-{num}-w{self.width or 0}-q{self.quality}.{self.format.value}"
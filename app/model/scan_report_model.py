@@ -0,0 +1,29 @@
+from pydantic import BaseModel
+
+
+class ScanReportModel(BaseModel):
+    incremental: bool = False
+    files_added: int = 0
+    files_moved: int = 0
+    files_updated: int = 0
+    files_skipped: int = 0
+    directories_added: int = 0
+    directories_updated: int = 0
+    directories_skipped: int = 0
+    # Pairs of directories the moved files were moved from and to
+    directories_moved: int = 0
+    errors: int = 0
+    # Throughput, files/sec counts every examined file while MB/sec only counts the files that had to be read
+    bytes_read: int = 0
+    duration: float = 0
+    files_per_second: float = 0
+    mb_per_second: float = 0
+
+    def files_examined(self) -> int:
+        return self.files_added + self.files_moved + self.files_updated + self.files_skipped
+
+    def end(self, duration: float):
+        self.duration = round(duration, 3)
+        if duration > 0:
+            self.files_per_second = round(self.files_examined() / duration, 2)
+            self.mb_per_second = round(self.bytes_read / duration / 1024 / 1024, 2)
@@ -0,0 +1,116 @@
+import io
+import logging
+import struct
+import zlib
+from typing import List, Tuple, BinaryIO
+from zipfile import ZipFile, ZipInfo, ZipExtFile, ZIP_STORED, ZIP_DEFLATED, structFileHeader, stringFileHeader, \
+    sizeFileHeader
+
+from rarfile import RarFile
+
+from app.model.file_model import PageOffsetModel
+from app.tools import is_image
+
+LOGGER = logging.getLogger(__name__)
+
+# Position of the file name length and extra field length in the unpacked local file header
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+_INDEXABLE_COMPRESS_TYPES = (ZIP_STORED, ZIP_DEFLATED)
+
+
+class ArchiveService:
+    @staticmethod
+    def index_pages(archive: ZipFile | RarFile) -> Tuple[List[str], List[PageOffsetModel] | None]:
+        """Create the sorted list of pages names of an opened archive, with the byte location of each page when the
+        archive is a zip that can be read without the zipfile module (no encryption, stored or deflated)"""
+        infos = sorted((item for item in archive.infolist() if is_image(item.filename)), key=lambda item: item.filename)
+        pages_names = [item.filename for item in infos]
+        if not isinstance(archive, ZipFile) or not all(ArchiveService.__is_indexable(item) for item in infos):
+            return pages_names, None
+        pages_offsets = [PageOffsetModel(offset=item.header_offset, compress_size=item.compress_size,
+                                         compress_type=item.compress_type, file_size=item.file_size, crc=item.CRC)
+                         for item in infos]
+        return pages_names, pages_offsets
+
+    @staticmethod
+    def __is_indexable(item: ZipInfo) -> bool:
+        return not item.flag_bits & 0x1 and item.compress_type in _INDEXABLE_COMPRESS_TYPES
+
+    @staticmethod
+    def __seek_page_data(file_io: BinaryIO, page: PageOffsetModel) -> bool:
+        """Move to the data of a page after checking its local file header"""
+        file_io.seek(page.offset)
+        header = file_io.read(sizeFileHeader)
+        if len(header) != sizeFileHeader:
+            return False
+        header = struct.unpack(structFileHeader, header)
+        if header[0] != stringFileHeader:
+            LOGGER.warning(f"Invalid local file header at offset {page.offset}, the page index is outdated")
+            return False
+        file_io.seek(header[_FH_FILENAME_LENGTH] + header[_FH_EXTRA_FIELD_LENGTH], 1)
+        return True
+
+    @staticmethod
+    def read_indexed_page(file_io: BinaryIO, page: PageOffsetModel) -> bytes | None:
+        """Read a page from a raw archive file object using its recorded location, return None if the data found
+        doesn't match the index so the caller can fall back to a regular archive opening"""
+        if not ArchiveService.__seek_page_data(file_io, page):
+            return None
+        data = file_io.read(page.compress_size)
+        if page.compress_type == ZIP_DEFLATED:
+            try:
+                data = zlib.decompress(data, -zlib.MAX_WBITS)
+            except zlib.error:
+                LOGGER.warning(f"Can't inflate page at offset {page.offset}, the page index is outdated")
+                return None
+        if len(data) != page.file_size or zlib.crc32(data) != page.crc:
+            LOGGER.warning(f"Page at offset {page.offset} doesn't match its index entry")
+            return None
+        return data
+
+    @staticmethod
+    def open_indexed_page(file_io: BinaryIO, page: PageOffsetModel, page_name: str) -> BinaryIO | None:
+        """Open a page from a raw archive file object using its recorded location as a stream of its decompressed
+        content, the CRC is checked once the stream is fully read. Closing the stream closes the file object.
+        Return None if the page header doesn't match the index"""
+        if not ArchiveService.__seek_page_data(file_io, page):
+            return None
+        info = ZipInfo(page_name)
+        info.compress_type = page.compress_type
+        info.compress_size = page.compress_size
+        info.file_size = page.file_size
+        info.CRC = page.crc
+        return ZipExtFile(file_io, "r", info, None, True)
+
+    @staticmethod
+    def open_member(file_io: BinaryIO, archive: ZipFile | RarFile, page_name: str) -> Tuple[BinaryIO, int]:
+        """Open a page of an opened archive as a stream with its size, closing the stream closes the archive and its
+        file object"""
+        return ArchiveMemberStream(archive.open(page_name), archive, file_io), archive.getinfo(page_name).file_size
+
+
+class ArchiveMemberStream(io.RawIOBase):
+    """Stream of an archive member keeping its archive open until it's closed"""
+
+    def __init__(self, member: BinaryIO, *resources):
+        super().__init__()
+        self.member = member
+        self.resources = resources
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self.member.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            for resource in (self.member, *self.resources):
+                try:
+                    resource.close()
+                except Exception as e:
+                    LOGGER.debug(f"Error while closing archive stream : {e}")
+        super().close()
@@ -0,0 +1,123 @@
+import logging
+import os
+import uuid
+import zipfile
+from contextlib import aclosing
+from os.path import splitext
+from typing import AsyncIterator, List, Tuple
+
+from app.enums.batch_format import BatchFormat
+from app.model.file_model import FileModel
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _ChunkBuffer:
+    """Write only buffer the zip entries are written to, drained after each entry. Without tell/seek the zipfile
+    module writes the archive sequentially as for a socket"""
+
+    def __init__(self):
+        self.__chunks: List[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.__chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.__chunks)
+        self.__chunks.clear()
+        return data
+
+
+class BatchService:
+    """Encoding of a range of pages in a single streamed response, only one page is held in memory at a time.
+
+    A batch going over MAX_BYTES once streamed ends with a `truncated` entry or part instead of the remaining pages,
+    its content is the number of the first page left out"""
+    MAX_PAGES = int(os.getenv("BATCH_MAX_PAGES", 50))
+    MAX_BYTES = int(os.getenv("BATCH_MAX_MB", 200)) * 1024 * 1024
+    TRUNCATED_NAME = "truncated"
+
+    @staticmethod
+    def page_file_name(file: FileModel, num: int) -> str:
+        """Name of a page in a batch, the page number padded so the pages are sorted by name"""
+        return f"{num:04d}{splitext(file.pages_names[num])[1].lower()}"
+
+    @staticmethod
+    def indexed_size(file: FileModel, nums: List[int]) -> int | None:
+        """Total size of the pages according to the pages index, None if the file isn't indexed"""
+        if not file.pages_offsets or len(file.pages_offsets) != len(file.pages_names):
+            return None
+        return sum(file.pages_offsets[num].file_size for num in nums)
+
+    @staticmethod
+    def media_type(batch_format: BatchFormat, boundary: str = None) -> str:
+        if batch_format == BatchFormat.MULTIPART:
+            return f"multipart/mixed; boundary={boundary}"
+        return "application/zip"
+
+    @staticmethod
+    async def encode(file: FileModel, pages: AsyncIterator[Tuple[int, bytes]], batch_format: BatchFormat,
+                     boundary: str = None) -> AsyncIterator[bytes]:
+        """Stream the pages as a zip or a multipart body, the pages are already compressed images so the zip
+        entries are only stored. The batch ends with a truncation marker if the pages are over the size limit"""
+        encoder = BatchService.__multipart if batch_format == BatchFormat.MULTIPART else BatchService.__zip
+        async for chunk in encoder(file, BatchService.__limit(file, pages), boundary):
+            yield chunk
+
+    @staticmethod
+    async def __limit(file: FileModel, pages: AsyncIterator[Tuple[int, bytes]]
+                      ) -> AsyncIterator[Tuple[int, bytes | None]]:
+        # The size of unindexed files is only known while reading them, the first page left out is yielded without
+        # content so the encoders can mark the batch as truncated
+        total = 0
+        async with aclosing(pages):
+            async for num, page in pages:
+                total += len(page)
+                if total > BatchService.MAX_BYTES:
+                    LOGGER.warning(f"{file.full_path} : batch truncated before page {num}, over "
+                                   f"{BatchService.MAX_BYTES} bytes")
+                    yield num, None
+                    return
+                yield num, page
+
+    @staticmethod
+    async def __zip(file: FileModel, pages: AsyncIterator[Tuple[int, bytes | None]], _) -> AsyncIterator[bytes]:
+        buffer = _ChunkBuffer()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+            async for num, page in pages:
+                if page is None:
+                    archive.writestr(BatchService.TRUNCATED_NAME, str(num))
+                else:
+                    archive.writestr(BatchService.page_file_name(file, num), page)
+                yield buffer.drain()
+        # Central directory
+        yield buffer.drain()
+
+    @staticmethod
+    async def __multipart(file: FileModel, pages: AsyncIterator[Tuple[int, bytes | None]],
+                          boundary: str) -> AsyncIterator[bytes]:
+        async for num, page in pages:
+            if page is None:
+                content = str(num).encode()
+                headers = f"--{boundary}\r\n" \
+                          f"Content-Type: text/plain\r\n" \
+                          f"Content-Disposition: inline; filename=\"{BatchService.TRUNCATED_NAME}\"\r\n" \
+                          f"Content-Length: {len(content)}\r\n\r\n"
+                yield headers.encode() + content + b"\r\n"
+                continue
+            name = BatchService.page_file_name(file, num)
+            headers = f"--{boundary}\r\n" \
+                      f"Content-Type: image/{name.split('.')[-1]}\r\n" \
+                      f"Content-Disposition: inline; filename=\"{name}\"\r\n" \
+                      f"Content-Length: {len(page)}\r\n" \
+                      f"X-Page-Number: {num}\r\n\r\n"
+            yield headers.encode() + page + b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    @staticmethod
+    def new_boundary() -> str:
+        return uuid.uuid4().hex
@@ -1,18 +1,26 @@
 import logging
 import re
 from datetime import datetime, timedelta
-from typing import List
+from typing import AsyncIterator, Dict, List, Tuple
 
 import pymongo
 from bson import ObjectId
 from fastapi import HTTPException
+from pymongo import IndexModel, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 
 from app.database_connect import db
+from app.model.directory_model import DirectoryCountsModel, DirectoryStateModel
 from app.model.file_model import FileModel, UpdateFileModel
 from app.model.library_model import LibraryModel, UpdateLibraryModel
+from app.services.library_cache_service import LibraryCache
+from app.services.progress_service import ProgressBuffer
 
 LOGGER = logging.getLogger(__name__)
 
+# MongoDB error code of a unique index violation
+DUPLICATE_KEY = 11000
+
 
 # ===========================
 # COLLECTION SPECIFIC METHODS
@@ -23,6 +31,21 @@ async def db_remove_collection(collection_name: str):
     return await db[collection_name].drop()
 
 
+async def db_index_information(collection_name: str) -> Dict[str, dict]:
+    """Get the existing indexes of a collection by name"""
+    return await db[collection_name].index_information()
+
+
+async def db_create_indexes(collection_name: str, indexes: List[IndexModel]) -> List[str]:
+    """Create indexes on a collection, existing identical indexes are left untouched"""
+    return await db[collection_name].create_indexes(indexes)
+
+
+async def db_index_stats(collection_name: str) -> List[dict]:
+    """Get the usage statistics of the indexes of a collection"""
+    return await db[collection_name].aggregate([{"$indexStats": {}}]).to_list(None)
+
+
 # =====================
 # FILE SPECIFIC METHODS
 # =====================
@@ -31,17 +54,23 @@ async def db_find_file(library_name: str, object_id: str) -> FileModel | None:
     file_dict = await db[library_name].find_one({"_id": ObjectId(object_id)})
     if file_dict is not None:
         LOGGER.debug(f"File id '{file_dict['full_path']}' found in database library {library_name}")
-        return FileModel(**file_dict)
+        return FileModel.from_document(ProgressBuffer.apply(library_name, file_dict))
     LOGGER.error(f"File id '{object_id}' not found in database library {library_name}")
     return None
 
 
+async def db_find_file_current_page(library_name: str, object_id: str) -> int | None:
+    """Find the current page of a file as written in database, None if the file isn't found"""
+    file_dict = await db[library_name].find_one({"_id": ObjectId(object_id)}, {"current_page": 1})
+    return file_dict.get("current_page", 0) if file_dict is not None else None
+
+
 async def db_find_file_by_full_path(library_name: str, file_path: str) -> FileModel | None:
     """Find a file in a library by full path"""
     file_dict = await db[library_name].find_one({"full_path": file_path})
     if file_dict is not None:
         LOGGER.debug(f"File full path '{file_dict['full_path']}' found in database library {library_name}")
-        return FileModel(**file_dict)
+        return FileModel.from_document(ProgressBuffer.apply(library_name, file_dict))
     LOGGER.error(f"File full path '{file_path}' not found in database library {library_name}")
     return None
 
@@ -51,15 +80,71 @@ async def db_find_file_by_md5(library_name: str, md5: str) -> FileModel | None:
     file_dict = await db[library_name].find_one({"md5": md5})
     if file_dict is not None:
         LOGGER.debug(f"File md5 '{file_dict['full_path']}' found in database library {library_name}")
-        return FileModel(**file_dict)
+        return FileModel.from_document(ProgressBuffer.apply(library_name, file_dict))
     LOGGER.error(f"File md5 '{md5}' not found in database library {library_name}")
     return None
 
 
+async def db_find_files_by_full_paths(library_name: str, file_paths: List[str]) -> Dict[str, FileModel]:
+    """Find the files in a library matching a list of full paths in a single query"""
+    if not file_paths:
+        return {}
+    files = {file_dict["full_path"]: FileModel.from_document(ProgressBuffer.apply(library_name, file_dict))
+             async for file_dict in db[library_name].find({"full_path": {"$in": file_paths}})}
+    LOGGER.debug(f"Found {len(files)} of {len(file_paths)} files by full path in database library {library_name}")
+    return files
+
+
+async def db_find_files_fields(library_name: str, file_paths: List[str], fields: List[str]) -> Dict[str, dict]:
+    """Find the files in a library matching a list of full paths in a single query, only the given fields (plus the
+    id and full path) are fetched"""
+    if not file_paths:
+        return {}
+    projection = {field: 1 for field in [*fields, "full_path"]}
+    return {file_dict["full_path"]: ProgressBuffer.apply(library_name, file_dict)
+            async for file_dict in db[library_name].find({"full_path": {"$in": file_paths}}, projection)}
+
+
+async def db_find_files_by_fingerprints(library_name: str, fingerprints: List[str]) -> Dict[str, List[FileModel]]:
+    """Find the files in a library matching a list of quick fingerprints in a single query, grouped by fingerprint"""
+    files = {}
+    if fingerprints:
+        async for file_dict in db[library_name].find({"fingerprint": {"$in": fingerprints}}):
+            files.setdefault(file_dict["fingerprint"], []).append(
+                FileModel.from_document(ProgressBuffer.apply(library_name, file_dict)))
+    LOGGER.debug(f"Found {len(files)} of {len(fingerprints)} fingerprints in database library {library_name}")
+    return files
+
+
+async def db_find_files_by_md5s(library_name: str, md5s: List[str]) -> Dict[str, FileModel]:
+    """Find the files in a library matching a list of md5 in a single query"""
+    if not md5s:
+        return {}
+    files = {file_dict["md5"]: FileModel.from_document(ProgressBuffer.apply(library_name, file_dict))
+             async for file_dict in db[library_name].find({"md5": {"$in": md5s}})}
+    LOGGER.debug(f"Found {len(files)} of {len(md5s)} md5 in database library {library_name}")
+    return files
+
+
 async def db_find_all_files(library_name: str) -> List[dict]:
     """Get a list of all files in library"""
     LOGGER.debug(f"Listing all files in library {library_name}")
-    return await db[library_name].find().to_list(None)
+    return [ProgressBuffer.apply(library_name, file_dict) async for file_dict in db[library_name].find()]
+
+
+async def db_iter_files_by_path(library_name: str, fields: List[str]) -> AsyncIterator[Tuple[str, List[dict]]]:
+    """Stream all the files of a library grouped by directory path, only the given fields (plus the id and path) are
+    fetched and a single directory is held in memory at a time"""
+    projection = {field: 1 for field in [*fields, "path"]}
+    path, files = None, []
+    async for file_dict in db[library_name].find({}, projection).sort([("path", pymongo.ASCENDING)]):
+        if file_dict["path"] != path and files:
+            yield path, files
+            files = []
+        path = file_dict["path"]
+        files.append(file_dict)
+    if files:
+        yield path, files
 
 
 async def db_find_first_child_in_path(library_name: str, dir_path: str) -> FileModel | None:
@@ -75,13 +160,14 @@ async def db_find_first_child_in_path(library_name: str, dir_path: str) -> FileM
             {"path": {"$regex": pattern}}, sort=[('path', pymongo.ASCENDING), ('name', pymongo.ASCENDING)])
     if file_dict is not None:
         LOGGER.debug(f"First file for path {dir_path} in library {library_name} is {file_dict['full_path']}")
-        return FileModel(**file_dict)
+        return FileModel.from_document(ProgressBuffer.apply(library_name, file_dict))
     LOGGER.info(f"Path {dir_path} in library {library_name} has no files")
     return None
 
 
 async def db_find_last_ongoing(library_name: str, limit: int) -> List[FileModel]:
     """Find the last updated files that have current_page > 0 and current_page != pages_count -1."""
+    await db_flush_progress(library_name)
     query = {
         "current_page": {"$gt": 0, "$ne": "None"},
         "$expr": {"$lt": ["$current_page", {"$subtract": ["$pages_count", 1]}]}
@@ -89,7 +175,7 @@ async def db_find_last_ongoing(library_name: str, limit: int) -> List[FileModel]
     cursor = db[library_name].find(query).sort([("update_date", pymongo.DESCENDING)]).limit(limit)
     ongoing_files = []
     async for document in cursor:
-        ongoing_files.append(FileModel(**document))
+        ongoing_files.append(FileModel.from_document(ProgressBuffer.apply(library_name, document)))
     LOGGER.info(f"Found {len(ongoing_files)} ongoing files in library {library_name}, limited to {limit}")
     return ongoing_files
 
@@ -99,7 +185,7 @@ async def db_find_last_added(library_name: str, limit: int) -> List[FileModel]:
     cursor = db[library_name].find({}).sort([("add_date", pymongo.DESCENDING)]).limit(limit)
     latest_files = []
     async for document in cursor:
-        latest_files.append(FileModel(**document))
+        latest_files.append(FileModel.from_document(ProgressBuffer.apply(library_name, document)))
     LOGGER.info(f"Found {len(latest_files)} recently added files in library {library_name}, limited to {limit}")
     return latest_files
 
@@ -114,19 +200,51 @@ async def db_find_last_added_by_days(library_name: str, days: int, limit: int =
         cursor = db[library_name].find(query).sort([("add_date", pymongo.DESCENDING)])
     latest_files = []
     async for document in cursor:
-        latest_files.append(FileModel(**document))
+        latest_files.append(FileModel.from_document(ProgressBuffer.apply(library_name, document)))
     LOGGER.info(f"Found {len(latest_files)} files added in the last {days} in library {library_name}, limited to {limit}")
     return latest_files
 
 
 async def db_insert_file(library_name: str, file: FileModel):
-    """Insert a new file in library"""
-    return await db[library_name].insert_one(file.dict(by_alias=True))
+    """Insert a new file in library, its pages manifest is inserted in the pages collection"""
+    result = await db[library_name].insert_one(file.dict(by_alias=True, exclude={"thumbnail_status", *PAGES_FIELDS}))
+    await db[pages_collection(library_name)].replace_one({"_id": file.id}, file.dict(include=PAGES_FIELDS),
+                                                         upsert=True)
+    return result
+
+
+async def db_insert_files(library_name: str, files: List[FileModel]) -> List[FileModel]:
+    """Insert new files in library in a single bulk operation, their pages manifests are inserted in the pages
+    collection. Return the files inserted, the ones whose full path already exists are skipped"""
+    inserted = files
+    try:
+        await db[library_name].insert_many([file.dict(by_alias=True, exclude={"thumbnail_status", *PAGES_FIELDS})
+                                            for file in files], ordered=False)
+    except BulkWriteError as e:
+        # Files inserted meanwhile by a concurrent listing or scan violate the unique full path index
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+        LOGGER.info(f"{len(duplicates)} files were already inserted in library {library_name}")
+        inserted = [file for index, file in enumerate(files) if index not in duplicates]
+    # Written once the files exist so a failed insert doesn't leave manifests without file
+    if inserted:
+        await db[pages_collection(library_name)].bulk_write(
+            [ReplaceOne({"_id": file.id}, file.dict(include=PAGES_FIELDS), upsert=True) for file in inserted],
+            ordered=False)
+    return inserted
 
 
 async def db_update_file(library_name: str, object_id: str, file: UpdateFileModel) -> FileModel:
     """Update an existing file by his id with an  update model"""
     file = {key: value for key, value in file.dict().items() if value is not None}
+    if "current_page" in file:
+        # Written now, the buffered progress is older
+        ProgressBuffer.discard(library_name, object_id)
+    if pages := {key: file.pop(key) for key in PAGES_FIELDS if key in file}:
+        await db[pages_collection(library_name)].update_one({"_id": ObjectId(object_id)}, {"$set": pages},
+                                                            upsert=True)
 
     # If there is modifications to do
     if len(file) >= 1:
@@ -142,11 +260,178 @@ async def db_update_file(library_name: str, object_id: str, file: UpdateFileMode
     raise HTTPException(status_code=404, detail=f"File {object_id} not found")
 
 
+async def db_update_files(library_name: str, files: Dict[str, UpdateFileModel]):
+    """Update existing files by their id with update models in a single bulk operation, updated files aren't read
+    back"""
+    updates, pages_updates = [], []
+    for object_id, file in files.items():
+        file = {key: value for key, value in file.dict().items() if value is not None}
+        if pages := {key: file.pop(key) for key in PAGES_FIELDS if key in file}:
+            pages_updates.append(UpdateOne({"_id": ObjectId(object_id)}, {"$set": pages}, upsert=True))
+        if file:
+            updates.append(UpdateOne({"_id": ObjectId(object_id)}, {"$set": file}))
+    if pages_updates:
+        await db[pages_collection(library_name)].bulk_write(pages_updates, ordered=False)
+    if updates:
+        return await db[library_name].bulk_write(updates, ordered=False)
+    return None
+
+
+async def db_flush_progress(library_name: str = None):
+    """Write the buffered reading progress of a library, or of all libraries, with a bulk operation per library.
+    The progress failing to be written stays buffered for the next flush"""
+    for name, progress in ProgressBuffer.snapshot(library_name).items():
+        updates = [UpdateOne({"_id": ObjectId(object_id)}, {"$set": file_progress})
+                   for object_id, file_progress in progress.items()]
+        try:
+            await db[name].bulk_write(updates, ordered=False)
+        except PyMongoError as e:
+            LOGGER.error(f"Can't write the reading progress of {len(updates)} files in library {name} : {e}")
+            continue
+        ProgressBuffer.acknowledge(name, progress)
+        LOGGER.debug(f"Wrote the reading progress of {len(updates)} files in library {name}")
+
+
 async def db_delete_file(library_name: str, object_id: str):
     """Delete a file data in library"""
+    await db[pages_collection(library_name)].delete_one({"_id": ObjectId(object_id)})
     return await db[library_name].delete_one({"_id": ObjectId(object_id)})
 
 
+async def db_delete_files(library_name: str, object_ids: List[str]):
+    """Delete several files data in library in a single operation"""
+    if not object_ids:
+        return None
+    query = {"_id": {"$in": [ObjectId(object_id) for object_id in object_ids]}}
+    await db[pages_collection(library_name)].delete_many(query)
+    return await db[library_name].delete_many(query)
+
+
+# ===============================
+# PAGES MANIFEST SPECIFIC METHODS
+# ===============================
+PAGES_FIELDS = {"pages_names", "pages_offsets"}
+
+
+def pages_collection(library_name: str) -> str:
+    """Name of the collection holding the pages manifests of a library files, kept out of the files documents as
+    only the pages serving needs them"""
+    return f"{library_name}.pages"
+
+
+async def db_find_file_pages(library_name: str, object_id: str) -> dict:
+    """Find the pages names and offsets of a file"""
+    pages = await db[pages_collection(library_name)].find_one({"_id": ObjectId(object_id)})
+    if pages is None:
+        # File not migrated yet, the manifest is still in its document
+        pages = await db[library_name].find_one({"_id": ObjectId(object_id), "pages_names": {"$exists": True}},
+                                                {field: 1 for field in PAGES_FIELDS})
+    if pages is None:
+        raise HTTPException(status_code=404, detail=f"Pages of file {object_id} not found")
+    return pages
+
+
+async def db_migrate_file_pages(library_name: str, batch_size: int = 500) -> int:
+    """Move the pages manifests still stored in the files documents to the pages collection, return the number of
+    files migrated"""
+    migrated = 0
+    cursor = db[library_name].find({"pages_names": {"$exists": True}}, {field: 1 for field in PAGES_FIELDS})
+    while batch := await cursor.to_list(batch_size):
+        # Written first so a file never lacks its manifest
+        await db[pages_collection(library_name)].bulk_write(
+            [ReplaceOne({"_id": pages["_id"]}, pages, upsert=True) for pages in batch], ordered=False)
+        await db[library_name].update_many({"_id": {"$in": [pages["_id"] for pages in batch]}},
+                                           {"$unset": {field: "" for field in PAGES_FIELDS}})
+        migrated += len(batch)
+    return migrated
+
+
+# ==========================
+# DIRECTORY SPECIFIC METHODS
+# ==========================
+def directories_collection(library_name: str) -> str:
+    """Name of the collection holding the directories state of a library"""
+    return f"{library_name}.directories"
+
+
+async def db_find_directory(library_name: str, path: str) -> DirectoryStateModel | None:
+    """Find the last scanned state of a directory"""
+    directory_dict = await db[directories_collection(library_name)].find_one({"path": path})
+    if directory_dict is not None:
+        return DirectoryStateModel(**directory_dict)
+    return None
+
+
+async def db_find_sub_directories(library_name: str, path: str) -> List[DirectoryStateModel]:
+    """Find the state of the direct sub-dirs of a directory"""
+    return [DirectoryStateModel(**directory_dict)
+            async for directory_dict in db[directories_collection(library_name)].find({"parent": path})]
+
+
+async def db_find_directories_and_sub_directories(library_name: str, paths: List[str]) -> List[DirectoryStateModel]:
+    """Find the state of directories and of their direct sub-dirs, the states saved before the parent was stored are
+    included as their parent is unknown"""
+    query = {"$or": [{"path": {"$in": paths}}, {"parent": {"$in": paths}}, {"parent": {"$exists": False}}]}
+    return [DirectoryStateModel(**directory_dict)
+            async for directory_dict in db[directories_collection(library_name)].find(query)]
+
+
+async def db_save_directory(library_name: str, directory: DirectoryStateModel):
+    """Insert or replace the scanned state of a directory, its counts are left untouched"""
+    state = directory.dict(exclude=set(DirectoryCountsModel.__fields__) | {"own"})
+    return await db[directories_collection(library_name)].update_one(
+        {"path": directory.path}, {"$set": state}, upsert=True)
+
+
+async def db_delete_directories(library_name: str, paths: List[str]):
+    """Delete the state of directories and of all their sub-dirs"""
+    if not paths:
+        return None
+    sub_dirs = [{"path": {"$regex": re.compile(rf'^{re.escape(path + "/")}')}} for path in paths]
+    return await db[directories_collection(library_name)].delete_many({"$or": [{"path": {"$in": paths}}, *sub_dirs]})
+
+
+async def db_find_directories_files_counts(library_name: str, paths: List[str]) -> Dict[str, DirectoryCountsModel]:
+    """Compute the counts of the files directly inside each given directory in a single aggregation"""
+    if not paths:
+        return {}
+    await db_flush_progress(library_name)
+    ongoing = {"$and": [{"$gt": ["$current_page", 0]}, {"$lt": ["$current_page", {"$subtract": ["$pages_count", 1]}]}]}
+    pipeline = [
+        {"$match": {"path": {"$in": paths}}},
+        {"$sort": {"path": pymongo.ASCENDING, "name": pymongo.ASCENDING}},
+        {"$group": {
+            "_id": "$path",
+            "first_child_id": {"$first": "$_id"},
+            "file_count": {"$sum": 1},
+            "total_pages": {"$sum": "$pages_count"},
+            "unread_count": {"$sum": {"$cond": [{"$gt": ["$current_page", 0]}, 0, 1]}},
+            "ongoing_count": {"$sum": {"$cond": [ongoing, 1, 0]}}
+        }}
+    ]
+    counts = {}
+    async for group in db[library_name].aggregate(pipeline):
+        group["first_child_id"] = str(group["first_child_id"])
+        counts[group.pop("_id")] = DirectoryCountsModel(**group)
+    return counts
+
+
+async def db_update_directories_counts(library_name: str, counts: Dict[str, dict]):
+    """Set the counts of several directories by path in a single bulk operation"""
+    if not counts:
+        return None
+    updates = [UpdateOne({"path": path}, {"$set": directory_counts}) for path, directory_counts in counts.items()]
+    return await db[directories_collection(library_name)].bulk_write(updates, ordered=False)
+
+
+async def db_inc_directory_counts(library_name: str, path: str, increments: Dict[str, int]):
+    """Increment the counts of the directory holding a file and of all its parents"""
+    return await db[directories_collection(library_name)].bulk_write([
+        UpdateOne({"path": path}, {"$inc": {f"own.{key}": value for key, value in increments.items()}}),
+        UpdateMany({"path": {"$in": DirectoryStateModel.lineage(path)}}, {"$inc": increments})
+    ], ordered=False)
+
+
 # ========================
 # LIBRARY SPECIFIC METHODS
 # ========================
@@ -155,17 +440,25 @@ LIBRARIES = "libraries"
 
 async def db_find_library(object_id: str) -> LibraryModel | None:
     """Find a library by id"""
+    if (library := LibraryCache.get_by_id(object_id)) is not None:
+        return library
     library_dict = await db[LIBRARIES].find_one({"_id": ObjectId(object_id)})
     if library_dict is not None:
-        return LibraryModel(**library_dict)
+        library = LibraryModel(**library_dict)
+        LibraryCache.put(library)
+        return library
     return None
 
 
 async def db_find_library_by_name(name: str) -> LibraryModel | None:
     """Find a library by name"""
+    if (library := LibraryCache.get_by_name(name)) is not None:
+        return library
     library_dict = await db[LIBRARIES].find_one({"name": name})
     if library_dict is not None:
-        return LibraryModel(**library_dict)
+        library = LibraryModel(**library_dict)
+        LibraryCache.put(library)
+        return library
     return None
 
 
@@ -176,7 +469,9 @@ async def db_find_all_libraries() -> List[LibraryModel]:
 
 async def db_insert_library(library: LibraryModel):
     """Create a new library"""
-    return await db[LIBRARIES].insert_one(library.dict(by_alias=True))
+    result = await db[LIBRARIES].insert_one(library.dict(by_alias=True))
+    LibraryCache.clear()
+    return result
 
 
 async def db_update_library(object_id: str, library: UpdateLibraryModel) -> LibraryModel:
@@ -186,6 +481,7 @@ async def db_update_library(object_id: str, library: UpdateLibraryModel) -> Libr
     # If there is modifications to do
     if len(library) >= 1:
         update_result = await db[LIBRARIES].update_one({"_id": ObjectId(object_id)}, {"$set": library})
+        LibraryCache.clear()
         if update_result.modified_count == 1:
             if (updated_library := await db_find_library(object_id)) is not None:
                 return updated_library
@@ -199,4 +495,6 @@ async def db_update_library(object_id: str, library: UpdateLibraryModel) -> Libr
 
 async def db_delete_library(object_id: str):
     """Delete a library"""
-    return await db[LIBRARIES].delete_one({"_id": ObjectId(object_id)})
+    result = await db[LIBRARIES].delete_one({"_id": ObjectId(object_id)})
+    LibraryCache.clear()
+    return result
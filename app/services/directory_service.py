@@ -1,67 +1,305 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
 import logging
-from os.path import join
+import os
+import time
+from datetime import datetime
+from os.path import join, dirname
 from pathlib import Path
-from app.model.directory_model import DirectoryModel
+from typing import Dict, Iterable, List, Tuple
+
+from app.model.directory_model import DirectoryModel, DirectoryStateModel, DirectoryCountsModel
+from app.model.file_model import FileModel
 from app.model.library_model import LibraryModel
-from app.services.db_service import db_find_first_child_in_path
+from app.model.scan_report_model import ScanReportModel
+from app.services.db_service import db_find_first_child_in_path, db_find_directory, db_save_directory, \
+    db_find_sub_directories, db_find_directories_and_sub_directories, db_delete_directories, \
+    db_find_directories_files_counts, db_update_directories_counts, db_find_files_fields, db_find_files_by_full_paths
 from app.services.file_service import FileService
-from app.services.storage_service import StorageService
+from app.services.storage_service import StorageService, StorageEntry
+from app.services.thumbnail_service import ThumbnailService, PENDING
 
 LOGGER = logging.getLogger(__name__)
 
+DIRECTORY_COUNTS = {"file_count", "total_pages", "unread_count", "ongoing_count"}
+# Fields of the files fetched for the content pages, the response fields and the ones telling if the file changed
+LISTING_FIELDS = ["name", "type", "pages_count", "current_page", "add_date", "update_date", "size", "mtime"]
+
 
 class DirectoryService:
     __supported_extensions = [".cbz", ".cbr"]
     __dir_name_blacklist = [".", "..", "@eaDir"]
+    # Number of files processed (opened, hashed, thumbnailed) at the same time, kept low on SMB to spare the NAS
+    SCAN_WORKERS = {
+        "local": int(os.getenv("SCAN_LOCAL_WORKERS", 4)),
+        "smb": int(os.getenv("SCAN_SMB_WORKERS", 2))
+    }
+    CONTENT_PAGE_SIZE = int(os.getenv("CONTENT_PAGE_SIZE", 200))
+
+    @classmethod
+    def scan_workers(cls, library: LibraryModel) -> int:
+        return max(cls.SCAN_WORKERS.get(library.connect_type, 1), 1)
 
     @classmethod
     async def get_dir_content(cls, library: LibraryModel, path: str, generate_thumbnails: bool = False,
-                              storage: StorageService = None, dir_thumbnail: bool = False):
+                              storage: StorageService = None, dir_thumbnail: bool = False,
+                              entries: List[StorageEntry] = None, report: ScanReportModel = None,
+                              workers: asyncio.Semaphore = None):
         """Return the content of the directory in two list, the list of sub-dirs and the list of supported files
          (as base model extensions)"""
-        dirs = []
-        files = []
         if not storage:
             storage = StorageService(library)
+        if not workers:
+            workers = asyncio.Semaphore(cls.scan_workers(library))
         LOGGER.debug(f"Getting content of folder : {path}")
-        storage_dirs, storage_files = await storage.get_dir_content(path)
-        # Directory list building
-        for directory in storage_dirs:
-            if (not directory.startswith('.')) and (directory not in cls.__dir_name_blacklist):
+        if entries is None:
+            entries = await storage.run(storage.list_dir, path)
+        dirs = await cls.__directory_models(library, path, [entry.name for entry in entries if entry.is_dir],
+                                            dir_thumbnail)
+
+        # Files list building, the database is queried once for the whole directory while the files are opened and
+        # hashed concurrently within the workers limit
+        file_entries = {join(path, entry.name): entry for entry in entries
+                        if not entry.is_dir and Path(entry.name).suffix in cls.__supported_extensions}
+        db_files = await FileService.get_files_from_db(library, file_entries, storage, report, workers)
+        files = [db_files[file_path] for file_path in file_entries if file_path in db_files]
+        if generate_thumbnails:
+            # Missing thumbnails are generated in background, the files are returned with a pending marker
+            for file in files:
+                if not await storage.run(storage.thumbnail_exist, file):
+                    ThumbnailService.enqueue(library, file)
+        LOGGER.info(f"Get dir content found {len(files)} files and {len(dirs)} directories in {path} of library {library}")
+        return dirs, files
+
+    @classmethod
+    async def get_dir_content_page(cls, library: LibraryModel, path: str, cursor: str = None, limit: int = None
+                                   ) -> Tuple[List[DirectoryModel], List[FileModel], str | None]:
+        """Return a page of the content of a directory, the sub-dirs then the files sorted by name, and the cursor of
+        the next page (None for the last page). The whole content is returned as a single page when neither a cursor
+        nor a limit is given, the pages are of CONTENT_PAGE_SIZE entries by default otherwise. Only the listed fields
+        of the files up to date in the database are fetched, so their models are partial, the others are created or
+        updated as by `get_dir_content`. Missing thumbnails are generated in background"""
+        if cursor is not None and limit is None:
+            limit = cls.CONTENT_PAGE_SIZE
+        after = cls.decode_cursor(cursor) if cursor else None
+        storage = StorageService(library)
+        LOGGER.debug(f"Getting content page of folder : {path} after {after}")
+        entries = await storage.run(storage.list_dir, path)
+        # The keys are unique in a directory and don't depend on the other entries, pages stay stable when entries
+        # are added or removed between requests
+        keyed_entries = sorted(
+            [((0, entry.name), entry) for entry in entries if entry.is_dir and cls.__is_visible_dir(entry.name)] +
+            [((1, entry.name), entry) for entry in entries
+             if not entry.is_dir and Path(entry.name).suffix in cls.__supported_extensions],
+            key=lambda keyed_entry: keyed_entry[0])
+        page = [(key, entry) for key, entry in keyed_entries if after is None or key > after]
+        next_cursor = None
+        if limit is not None and len(page) > limit:
+            next_cursor = cls.encode_cursor(page[limit - 1][0])
+            page = page[:limit]
+
+        dirs = await cls.__directory_models(library, path, [entry.name for key, entry in page if key[0] == 0], True)
+        file_entries = {join(path, entry.name): entry for key, entry in page if key[0] == 1}
+        listed = {file_path: listed_file
+                  for file_path, listed_file in (await db_find_files_fields(library.name, list(file_entries),
+                                                                            LISTING_FIELDS)).items()
+                  if (listed_file.get("size"), listed_file.get("mtime")) == (file_entries[file_path].size,
+                                                                             file_entries[file_path].mtime)}
+        synced = await FileService.get_files_from_db(
+            library, {file_path: entry for file_path, entry in file_entries.items() if file_path not in listed},
+            storage, workers=asyncio.Semaphore(cls.scan_workers(library)))
+        files = []
+        missing_thumbnails = []
+        for file_path in file_entries:
+            if file_path in listed:
+                file = FileModel.from_document(listed[file_path])
+            elif file_path in synced:
+                file = synced[file_path]
+            else:
+                continue
+            if not await storage.run(storage.thumbnail_exist, file):
+                file.thumbnail_status = PENDING
+                missing_thumbnails.append(file_path)
+            files.append(file)
+        # The thumbnails generation needs the whole files
+        missing = {**await db_find_files_by_full_paths(
+            library.name, [file_path for file_path in missing_thumbnails if file_path not in synced]), **synced}
+        for file_path in missing_thumbnails:
+            if file_path in missing:
+                ThumbnailService.enqueue(library, missing[file_path])
+        LOGGER.info(f"Get dir content page found {len(files)} files and {len(dirs)} directories in {path} of library "
+                    f"{library}")
+        return dirs, files, next_cursor
+
+    @staticmethod
+    def encode_cursor(key: Tuple[int, str]) -> str:
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[int, str]:
+        """Sort key of the last entry of the previous page, raise ValueError if the cursor is invalid"""
+        try:
+            kind, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (TypeError, binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ValueError(f"Invalid cursor {cursor}") from e
+        if kind not in (0, 1) or not isinstance(name, str):
+            raise ValueError(f"Invalid cursor {cursor}")
+        return kind, name
+
+    @classmethod
+    async def __directory_models(cls, library: LibraryModel, path: str, names: List[str],
+                                 dir_thumbnail: bool) -> List[DirectoryModel]:
+        """Build the models of sub-dirs, thumbnails and counts come from the scanned directories state in a single
+        query"""
+        dirs = []
+        states = {state.path: state for state in await db_find_sub_directories(library.name, path)} \
+            if dir_thumbnail else {}
+        for directory in names:
+            if cls.__is_visible_dir(directory):
                 LOGGER.debug(f"Found directory : {join(path, directory)}")
                 dir_model = DirectoryModel.create(join(path, directory))
-                if dir_thumbnail:
+                if (state := states.get(dir_model.path)) is not None:
+                    dir_model = dir_model.copy(update=state.dict(include=DIRECTORY_COUNTS))
+                    dir_model.thumbnail_id = state.first_child_id
+                elif dir_thumbnail:
+                    # Directory not scanned yet
                     dir_model.thumbnail_id = await DirectoryService.get_dir_thumbnail(library, dir_model)
                 dirs.append(dir_model)
-
-        # Files list building
-        for file in storage_files:
-            if Path(file).suffix in cls.__supported_extensions:
-                if (db_file := await FileService.get_file_from_db(library, join(path, file), storage)) is not None:
-                    LOGGER.debug(f"Found file : {db_file.full_path}")
-                    files.append(db_file)
-                    # Thumbnail management if needed
-                    if generate_thumbnails and not storage.thumbnail_exist(db_file):
-                        thumbnail = FileService.generate_thumbnail_cover(library, db_file, storage)
-                        if thumbnail:
-                            storage.save_thumbnail(db_file, thumbnail)
-        LOGGER.info(f"Get dir content found {len(files)} files and {len(dirs)} directories in {path} of library {library}")
-        return dirs, files
+        return dirs
 
     @classmethod
-    async def scan_in_depth(cls, library: LibraryModel, path: str, storage: StorageService = None):
+    async def scan_in_depth(cls, library: LibraryModel, path: str, storage: StorageService = None,
+                            incremental: bool = False) -> ScanReportModel:
         """
         Use in depth scanning to go to every folder and sub-folder and analyse the files to make sure they're referenced
-        in database or add them if they're not
+        in database or add them if they're not.
+        With incremental scanning the directories whose listing didn't change since the last scan are skipped.
+        Directories are walked from a work queue by several walkers sharing the same file workers limit.
         """
         if not storage:
             storage = StorageService(library)
-        # Scan base dir
-        dirs, files = await DirectoryService.get_dir_content(library, path, True, storage)
+        report = ScanReportModel(incremental=incremental)
+        workers = asyncio.Semaphore(cls.scan_workers(library))
+        queue: asyncio.Queue[str] = asyncio.Queue()
+        queue.put_nowait(path)
+        changed_dirs: List[str] = []
+        start = time.monotonic()
+
+        async def walk():
+            while True:
+                directory = await queue.get()
+                try:
+                    for sub_dir in await cls.__scan_directory(library, directory, storage, incremental, report,
+                                                              workers, changed_dirs):
+                        queue.put_nowait(sub_dir)
+                except Exception as e:
+                    report.errors += 1
+                    LOGGER.exception(f"Error while scanning {directory} of library {library.name} : {e}", exc_info=e)
+                finally:
+                    queue.task_done()
+
+        walkers = [asyncio.create_task(walk()) for _ in range(cls.scan_workers(library))]
+        try:
+            await queue.join()
+        finally:
+            for walker in walkers:
+                walker.cancel()
+            await asyncio.gather(*walkers, return_exceptions=True)
+        if changed_dirs:
+            await cls.refresh_directories(library, changed_dirs)
+        report.end(time.monotonic() - start)
+        return report
+
+    @classmethod
+    async def __scan_directory(cls, library: LibraryModel, path: str, storage: StorageService, incremental: bool,
+                               report: ScanReportModel, workers: asyncio.Semaphore,
+                               changed_dirs: List[str]) -> List[str]:
+        """Scan the files of a single directory and return the paths of its sub-dirs, re-scanned directories are added
+        to the changed directories"""
+        entries = await storage.run(storage.list_dir, path)
+        signature = cls.__listing_signature(entries)
+        state = await db_find_directory(library.name, path)
+
+        if incremental and state is not None and state.signature == signature:
+            LOGGER.debug(f"Directory {path} unchanged since last scan, skipping files")
+            report.directories_skipped += 1
+            sub_dirs = [join(path, directory) for directory in state.dirs]
+        else:
+            # Scan base dir
+            dirs, files = await DirectoryService.get_dir_content(library, path, True, storage, entries=entries,
+                                                                 report=report, workers=workers)
+            sub_dirs = [directory.path for directory in dirs]
+            await db_save_directory(library.name, DirectoryStateModel(
+                path=path, parent=dirname(path) if path else None, mtime=(await storage.run(storage.stat, path))[1],
+                signature=signature, dirs=[directory.name for directory in dirs], scan_date=datetime.now()))
+            if state is not None:
+                await db_delete_directories(library.name, [join(path, directory) for directory in state.dirs
+                                                           if join(path, directory) not in sub_dirs])
+            changed_dirs.append(path)
+            if state is None:
+                report.directories_added += 1
+            elif state.signature != signature:
+                # Unchanged directories are also rescanned by full scans
+                report.directories_updated += 1
+        return sub_dirs
+
+    @classmethod
+    def __is_visible_dir(cls, name: str) -> bool:
+        return (not name.startswith('.')) and (name not in cls.__dir_name_blacklist)
+
+    @classmethod
+    def __listing_signature(cls, entries: List[StorageEntry]) -> str:
+        """Hash the listing of a directory, sub-dirs modification times are left out as they change with their own
+        content which is checked separately"""
+        hasher = hashlib.md5()
+        for entry in sorted(entries):
+            if entry.is_dir and cls.__is_visible_dir(entry.name):
+                hasher.update(f"d:{entry.name}\n".encode())
+            elif Path(entry.name).suffix in cls.__supported_extensions:
+                hasher.update(f"f:{entry.name}:{entry.size}:{entry.mtime}\n".encode())
+        return hasher.hexdigest()
+
+    @classmethod
+    async def refresh_directories(cls, library: LibraryModel, paths: Iterable[str]):
+        """Recount the files directly inside the given directories then roll the counts up to the library root, only
+        the directories whose counts changed are written"""
+        paths = list(set(paths))
+        own_counts = await db_find_directories_files_counts(library.name, paths)
+        # The directories and their parents are summed again from the counts of their direct sub-dirs
+        lineage = {parent for path in paths for parent in DirectoryStateModel.lineage(path)}
+        directories = {state.path: state
+                       for state in await db_find_directories_and_sub_directories(library.name, list(lineage))}
+        updates = {}
+        for path in paths:
+            if path in directories:
+                directories[path].own = own_counts.get(path, DirectoryCountsModel())
+                updates[path] = {"own": directories[path].own.dict()}
 
-        # Scan sub-folders
-        for directory in dirs:
-            await DirectoryService.scan_in_depth(library, directory.path, storage=storage)
+        # Deepest directories first so the sub-dirs are always summed before their parent
+        children: Dict[str, List[DirectoryStateModel]] = {}
+        for state in directories.values():
+            if state.path:
+                children.setdefault(dirname(state.path), []).append(state)
+                if state.parent is None:
+                    # State saved before the parent was stored
+                    updates.setdefault(state.path, {})["parent"] = dirname(state.path)
+        for state in sorted((directories[path] for path in lineage if path in directories),
+                            key=lambda directory: directory.path.count("/") + bool(directory.path), reverse=True):
+            sub_dirs = sorted(children.get(state.path, []), key=lambda directory: directory.path)
+            counts = DirectoryCountsModel(first_child_id=state.own.first_child_id or next(
+                (sub_dir.first_child_id for sub_dir in sub_dirs if sub_dir.first_child_id), None))
+            for counted in [state.own] + sub_dirs:
+                for field in DIRECTORY_COUNTS:
+                    setattr(counts, field, getattr(counts, field) + getattr(counted, field))
+            if counts != DirectoryCountsModel(**state.dict(include=set(DirectoryCountsModel.__fields__))):
+                updates.setdefault(state.path, {}).update(counts.dict())
+                for field, value in counts.dict().items():
+                    setattr(state, field, value)
+        await db_update_directories_counts(library.name, updates)
+        LOGGER.info(f"Refreshed {len(paths)} directories counts of library {library.name}, {len(updates)} updated")
 
     @classmethod
     async def get_dir_thumbnail(cls, library: LibraryModel, dir_model: DirectoryModel) -> str | None:
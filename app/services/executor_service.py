@@ -0,0 +1,72 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, TypeVar
+
+from app.model.library_model import LibraryModel
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class ExecutorService:
+    """Bounded thread pools running the blocking storage and archive work off the event loop.
+    Each storage backend type has its own pool so a slow SMB share can't starve the local libraries.
+    CPU bound image work runs in a process pool to not be serialized by the GIL."""
+    WORKERS = {
+        "local": int(os.getenv("LOCAL_STORAGE_WORKERS", 8)),
+        "smb": int(os.getenv("SMB_STORAGE_WORKERS", 4))
+    }
+    IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 2))
+
+    __executors: Dict[str, ThreadPoolExecutor] = {}
+    __process_executor: ProcessPoolExecutor | None = None
+    __lock = threading.Lock()
+
+    @classmethod
+    def get_executor(cls, connect_type: str) -> ThreadPoolExecutor:
+        with cls.__lock:
+            if (executor := cls.__executors.get(connect_type)) is None:
+                workers = cls.WORKERS.get(connect_type, 4)
+                LOGGER.info(f"Starting {connect_type} storage executor with {workers} workers")
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"storage-{connect_type}")
+                cls.__executors[connect_type] = executor
+            return executor
+
+    @classmethod
+    async def run(cls, library: LibraryModel, func: Callable[..., T], *args, **kwargs) -> T:
+        """Run a blocking function in the executor of the library backend type and wait for its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(cls.get_executor(library.connect_type),
+                                          functools.partial(func, *args, **kwargs))
+
+    @classmethod
+    def get_process_executor(cls) -> ProcessPoolExecutor:
+        with cls.__lock:
+            if cls.__process_executor is None:
+                LOGGER.info(f"Starting image process pool with {cls.IMAGE_WORKERS} workers")
+                # Spawned rather than forked, forking a process running threads and an event loop isn't safe
+                cls.__process_executor = ProcessPoolExecutor(max_workers=cls.IMAGE_WORKERS,
+                                                             mp_context=multiprocessing.get_context("spawn"))
+            return cls.__process_executor
+
+    @classmethod
+    async def run_cpu(cls, func: Callable[..., T], *args) -> T:
+        """Run a CPU bound function in the process pool, the function and its arguments must be picklable"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(cls.get_process_executor(), func, *args)
+
+    @classmethod
+    def shutdown(cls):
+        with cls.__lock:
+            for executor in cls.__executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+            cls.__executors.clear()
+            if cls.__process_executor is not None:
+                cls.__process_executor.shutdown(wait=False, cancel_futures=True)
+                cls.__process_executor = None
@@ -1,29 +1,48 @@
-from datetime import datetime
+import asyncio
 import io
+from datetime import datetime
 import logging
 import os
 from os.path import splitext, basename
+from typing import AsyncIterator, BinaryIO, Callable, Dict, List, Set, Tuple, TypeVar
 from zipfile import ZipFile, BadZipfile
 from rarfile import RarFile, BadRarFile, NotRarFile
-from PIL import Image, UnidentifiedImageError
+from PIL import UnidentifiedImageError
+from pymongo.errors import PyMongoError
 
 from app.enums.type_model import TypeModel
-from app.model.file_model import FileModel, UpdateFileModel
+from app.model.file_model import FileModel, UpdateFileModel, PageOffsetModel
 from app.model.library_model import LibraryModel
-from app.services.db_service import db_update_file, db_find_file_by_full_path, db_find_file_by_md5, db_insert_file, \
-    db_find_file, db_find_all_files, db_delete_file
-from app.services.storage_service import StorageService
+from app.model.scan_report_model import ScanReportModel
+from app.services.db_service import db_update_file, db_iter_files_by_path, db_delete_files, db_insert_files, \
+    db_update_files, db_find_files_by_full_paths, db_find_files_by_fingerprints, db_find_files_by_md5s, \
+    db_inc_directory_counts, db_find_file_pages, db_migrate_file_pages, db_find_all_libraries, \
+    db_find_file_current_page
+from app.services.executor_service import ExecutorService
+from app.services.image_service import ImageService
+from app.services.page_cache_service import PageCache
+from app.services.prefetch_service import PrefetchService
+from app.services.progress_service import ProgressBuffer
+from app.services.storage_service import StorageService, StorageEntry
 
 LOGGER = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 class FileService:
+    STREAM_CHUNK_SIZE = 256 * 1024
+    PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", 1000))
+
     @staticmethod
-    def create_file_model(library: LibraryModel, file_path: str, storage: StorageService = None):
+    def create_file_model(library: LibraryModel, file_path: str, storage: StorageService = None,
+                          fingerprint: str = None):
         name, extension = splitext(basename(file_path))
         if not storage:
             storage = StorageService(library)
-        pages_list = storage.list_pages(file_path, FileService.get_opener_lib(file_path, storage))
+        # Stat before indexing so a file modified meanwhile won't match its index anymore
+        size, mtime = storage.stat(file_path)
+        pages_list, pages_offsets = storage.index_pages(file_path, FileService.get_opener_lib(file_path, storage))
         file_dict = {
             "full_path": file_path,
             "path": os.path.dirname(file_path),
@@ -32,8 +51,12 @@ class FileService:
             "type": TypeModel.FILE.value,
             "pages_count": len(pages_list),
             "pages_names": pages_list,
+            "pages_offsets": pages_offsets,
             "current_page": 0,
-            "md5": storage.calculate_md5(file_path)
+            "md5": storage.calculate_md5(file_path),
+            "fingerprint": fingerprint or storage.calculate_fingerprint(file_path),
+            "size": size,
+            "mtime": mtime
         }
         return FileModel(**file_dict)
 
@@ -63,81 +86,361 @@ class FileService:
         raise ValueError(f"Invalid file extension: {splitext(basename(file_path))[1]}")
 
     @staticmethod
-    async def get_file_from_db(library: LibraryModel, file_path: str, storage: StorageService = None) -> FileModel:
-        """Get a file in the database or create it otherwise"""
+    async def get_file_from_db(library: LibraryModel, file_path: str, storage: StorageService = None,
+                               entry: StorageEntry = None, report: ScanReportModel = None) -> FileModel | None:
+        """Get a file in the database or create it otherwise. When the storage entry of the file is given, known files
+        whose size or modification time changed are updated"""
+        return (await FileService.get_files_from_db(library, {file_path: entry}, storage, report)).get(file_path)
+
+    @staticmethod
+    async def get_files_from_db(library: LibraryModel, files: Dict[str, StorageEntry | None],
+                                storage: StorageService = None, report: ScanReportModel = None,
+                                workers: asyncio.Semaphore = None) -> Dict[str, FileModel]:
+        """Get files in the database by their path or create them otherwise. Known files are resolved with a single
+        query, moved/renamed files are searched by fingerprint then md5 and new files are inserted in bulk.
+        Storage work (hashing, page listing) runs concurrently within the workers limit."""
         if not storage:
             storage = StorageService(library)
-        # Check if file exist in database with path
-        LOGGER.debug(f"Searching for {file_path} existence in database")
-        db_file = await db_find_file_by_full_path(library.name, file_path)
-        if db_file:
-            LOGGER.debug(f"{file_path} : database ok")
-            return db_file
-        else:
-            # File is not found, calculate md5 and search it to make sure the file wasn't moved/renamed
-            # Create a new FileModel to avoid recalculating md5 if it doesn't exist in database anyway
+        if not report:
+            report = ScanReportModel()
+        if not workers:
+            workers = asyncio.Semaphore(1)
+
+        async def bounded(coroutine):
+            async with workers:
+                return await coroutine
+
+        # Check if files exist in database with path
+        LOGGER.debug(f"Searching for {len(files)} files existence in database")
+        known_files = await db_find_files_by_full_paths(library.name, list(files))
+        result: Dict[str, FileModel] = {}
+        changed_files = []
+        for file_path, entry in files.items():
+            if (db_file := known_files.get(file_path)) is None:
+                continue
+            if entry is not None and (db_file.size, db_file.mtime) != (entry.size, entry.mtime):
+                changed_files.append((db_file, entry))
+            else:
+                LOGGER.debug(f"{file_path} : database ok")
+                report.files_skipped += 1
+                result[file_path] = db_file
+        for db_file in await asyncio.gather(*(bounded(FileService.__update_changed_file(
+                library, db_file, entry, storage, report)) for db_file, entry in changed_files)):
+            if db_file is not None:
+                result[db_file.full_path] = db_file
+
+        # Files not found are searched by fingerprint then md5 to make sure they weren't moved/renamed
+        new_paths = [file_path for file_path in files if file_path not in known_files]
+        if not new_paths:
+            return result
+        fingerprints = dict(zip(new_paths, await asyncio.gather(*(
+            bounded(FileService.__read_storage(storage.calculate_fingerprint, file_path, storage))
+            for file_path in new_paths))))
+        candidates = await db_find_files_by_fingerprints(
+            library.name, [fingerprint for fingerprint in fingerprints.values() if fingerprint])
+        moves: Dict[str, Tuple[FileModel, UpdateFileModel]] = {}
+        paths_to_create = []
+        for file_path, fingerprint in fingerprints.items():
+            if fingerprint is None:
+                continue
+            matches = [match for match in candidates.get(fingerprint, []) if str(match.id) not in moves]
+            if len(matches) == 1:
+                file_updated = UpdateFileModel.update_path(file_path)
+                if (entry := files[file_path]) is not None:
+                    # Otherwise they're recorded when the file is next listed with its entry
+                    file_updated.size, file_updated.mtime = entry.size, entry.mtime
+                moves[str(matches[0].id)] = (matches[0], file_updated)
+            else:
+                # Unknown file or fingerprint shared by several files, the md5 calculated with the file model decides
+                paths_to_create.append(file_path)
+
+        # Create new FileModels, they're only inserted if their md5 doesn't exist in database either
+        new_files = [file for file in await asyncio.gather(*(
+            bounded(FileService.__read_storage(FileService.create_file_model, file_path, storage, library, file_path,
+                                               storage, fingerprints[file_path]))
+            for file_path in paths_to_create)) if file is not None]
+        # Entries created before fingerprints existed can only be found by md5
+        md5_matches = await db_find_files_by_md5s(library.name, [file.md5 for file in new_files])
+        files_to_insert = []
+        for file in new_files:
+            report.bytes_read += file.size
+            if file.pages_count == 0:
+                LOGGER.error(f"File : '{file.full_path}', no readable pages found, ignoring file")
+            elif (db_file := md5_matches.get(file.md5)) is not None and str(db_file.id) not in moves:
+                # TODO Before updating check if old file exist, if yes allow duplicate and create new entry in db
+                # Else update existing entry
+                # WARNING: this will prevent duplicate file from being listed multiple times,
+                # database will only mention last file found by md5
+                file_updated = UpdateFileModel.update_path(file.full_path)
+                file_updated.fingerprint = file.fingerprint
+                file_updated.size, file_updated.mtime = file.size, file.mtime
+                moves[str(db_file.id)] = (db_file, file_updated)
+            else:
+                # If file isn't found by md5, add a new entry in the database
+                file.add_date = datetime.now()
+                file.update_date = file.add_date
+                files_to_insert.append(file)
+
+        if files_to_insert:
+            inserted = await db_insert_files(library.name, files_to_insert)
+            for file in inserted:
+                LOGGER.info(f"{file.full_path} : added new entry in database {file.id}")
+                result[file.full_path] = file
+            report.files_added += len(inserted)
+            if len(inserted) < len(files_to_insert):
+                # Inserted meanwhile by a concurrent listing or scan, their entries are the ones to return
+                inserted_paths = {file.full_path for file in inserted}
+                result.update(await db_find_files_by_full_paths(
+                    library.name, [file.full_path for file in files_to_insert if file.full_path not in inserted_paths]))
+        if moves:
+            await db_update_files(library.name, {file_id: update for file_id, (_, update) in moves.items()})
+            for db_file, file_updated in moves.values():
+                LOGGER.info(f"{db_file.full_path} : updating to new location {file_updated.full_path}")
+                result[file_updated.full_path] = db_file.copy(update=file_updated.dict(exclude_none=True))
+            report.files_moved += len(moves)
+            report.directories_moved += len({(db_file.path, file_updated.path)
+                                             for db_file, file_updated in moves.values()
+                                             if db_file.path != file_updated.path})
+        return result
+
+    @staticmethod
+    async def __read_storage(func: Callable[..., T], file_path: str, storage: StorageService, *args) -> T | None:
+        """Run a storage call reading a file, files that aren't valid archives or that were removed meanwhile are logged
+        and ignored. Storage errors are raised so a file isn't taken for an invalid one when the storage fails"""
+        try:
+            return await storage.run(func, *(args or (file_path,)))
+        except (BadZipfile, BadRarFile, NotRarFile):
+            LOGGER.error(f"Unreadable file : '{file_path}', ignoring file")
+        except (ValueError, FileNotFoundError) as e:
+            # No opener lib for the file or file removed since it was listed
+            LOGGER.error(f"{file_path} : {e}")
+        return None
+
+    @staticmethod
+    async def __update_changed_file(library: LibraryModel, db_file: FileModel, entry: StorageEntry,
+                                    storage: StorageService, report: ScanReportModel) -> FileModel | None:
+        """Refresh the data of a file modified in place, its thumbnail is removed when its content changed"""
+        report.files_updated += 1
+        if db_file.size is None:
+            # Entry created before sizes were stored, only record them
+            return await db_update_file(library.name, str(db_file.id),
+                                        UpdateFileModel(size=entry.size, mtime=entry.mtime))
+        LOGGER.info(f"{db_file.full_path} : file changed on storage, updating its data")
+        file = await FileService.__read_storage(FileService.create_file_model, db_file.full_path, storage, library,
+                                                db_file.full_path, storage)
+        if file is None:
+            return None
+        report.bytes_read += file.size
+        PageCache.invalidate(db_file.md5)
+        file_updated = UpdateFileModel(**file.dict(include={"pages_count", "pages_names", "pages_offsets", "md5",
+                                                            "fingerprint", "size", "mtime"}))
+        file_updated.current_page = min(db_file.current_page, max(file.pages_count - 1, 0))
+        updated_file = await db_update_file(library.name, str(db_file.id), file_updated)
+        if file.md5 != db_file.md5:
+            # The cover may have changed, the listings and scans queue the generation of the missing thumbnails
             try:
-                file = FileService.create_file_model(library, file_path, storage)
-                LOGGER.debug(f"Searching for {file.name} md5 {file.md5} existence in database")
-                db_file = await db_find_file_by_md5(library.name, file.md5)
-                if file.pages_count == 0:
-                    LOGGER.error(f"File : '{file_path}', no readable pages found, ignoring file")
-                else:
-                    if not db_file:
-                        # If file isn't found by md5, add a new entry in the database
-                        file.add_date = datetime.now()
-                        file.update_date = file.add_date
-                        insert_result = await db_insert_file(library.name, file)
-                        LOGGER.info(f"{file.full_path} : added new entry in database {insert_result.inserted_id}")
-                        return await db_find_file(library.name, insert_result.inserted_id)
-                    else:
-                        # TODO Before updating check if old file exist, if yes allow duplicate and create new entry in db
-                        # Else update existing entry
-                        # WARNING: this will prevent duplicate file from being listed multiple times,
-                        # database will only mention last file found by md5
-                        LOGGER.info(f"{db_file.full_path} : updating to new location {file.full_path}")
-                        file_updated = UpdateFileModel.update_path(file_path)
-                        return await db_update_file(library.name, str(db_file.id), file_updated)
-            except (BadZipfile, BadRarFile, NotRarFile):
-                LOGGER.error(f"Unreadable file : '{file_path}', ignoring file")
-            except ValueError as e:
-                LOGGER.error(str(e))
-
-    @staticmethod
-    async def purge_deleted_files(library: LibraryModel, storage: StorageService = None):
+                await storage.run(storage.delete_thumbnail, db_file)
+            except Exception as e:
+                LOGGER.exception(f"{db_file.full_path} : can't remove outdated thumbnail : {e}", exc_info=e)
+        return updated_file
+
+    @staticmethod
+    async def purge_deleted_files(library: LibraryModel, storage: StorageService = None) -> Set[str]:
         """This method will look at every file reference in database and check if there is an actual file on the
-        corresponding path, if no file is found the database entry is removed.
+        corresponding path, if no file is found the database entry is removed. The directories of the removed files
+        are returned.
+        The files are streamed grouped by directory so each directory is listed once, the removals are done in
+        batches of PURGE_BATCH_SIZE files.
         WARNING: This method is designed to be run just after a scan and might remove wrong data if the database is not
         up-to-date"""
         LOGGER.info("File purge started")
-        files = await db_find_all_files(library.name)
         if not storage:
             storage = StorageService(library)
+        purged_paths = set()
+        purged_files = []
+        async for path, files in db_iter_files_by_path(library.name, ["full_path", "md5"]):
+            names = await storage.run(storage.list_file_names, path)
+            for file in files:
+                if basename(file["full_path"]) not in names:
+                    LOGGER.info(f"File {file['full_path']} purged from library {library.name} because no actual file "
+                                f"was found")
+                    purged_paths.add(path)
+                    purged_files.append(file)
+            if len(purged_files) >= FileService.PURGE_BATCH_SIZE:
+                await FileService.__delete_files(library, purged_files, storage)
+                purged_files = []
+        await FileService.__delete_files(library, purged_files, storage)
+        LOGGER.info(f"File purge ended, files removed from {len(purged_paths)} directories")
+        return purged_paths
+
+    @staticmethod
+    async def __delete_files(library: LibraryModel, files: List[dict], storage: StorageService):
+        if not files:
+            return
+        file_ids = [str(file["_id"]) for file in files]
+        await db_delete_files(library.name, file_ids)
         for file in files:
-            if not storage.isfile(file["full_path"]):
-                await db_delete_file(library.name, str(file["_id"]))
-                storage.delete_thumbnail(FileModel(**file))
-                LOGGER.info(f"File {file['name']} purged from library {library.name} because no actual file was found")
-        LOGGER.info("File purge ended")
+            PageCache.invalidate(file["md5"])
+        try:
+            await storage.run(storage.delete_thumbnails, file_ids)
+        except Exception as e:
+            # The files are already removed, their directories must still be refreshed
+            LOGGER.exception(f"Thumbnails removal failed in library {library.name} : {e}", exc_info=e)
 
     @staticmethod
-    def get_page(library: LibraryModel, file: FileModel, num: int = 0, storage: StorageService = None) -> bytes:
+    async def get_page(library: LibraryModel, file: FileModel, num: int = 0, storage: StorageService = None) -> bytes:
         """Get a specific page with a given number"""
+        await PrefetchService.wait_pending(file, num)
+        return await FileService.__fetch_page(library, file, num, storage)
+
+    @staticmethod
+    async def __fetch_page(library: LibraryModel, file: FileModel, num: int, storage: StorageService = None) -> bytes:
+        if (page := PageCache.get(file.md5, num)) is not None:
+            return page
+        await FileService.load_pages(library, file)
         if not storage:
             storage = StorageService(library)
+        page = await storage.run(FileService.__load_page, file, num, storage)
+        if page is not None:
+            PageCache.put(file.md5, num, page)
+        return page
+
+    @staticmethod
+    def __load_page(file: FileModel, num: int, storage: StorageService) -> bytes:
+        # The pages index avoids opening the archive at all, even to find out its type
+        if (page := storage.get_indexed_page(file, num)) is not None:
+            return page
         return storage.get_page(file, FileService.get_opener_lib(file.full_path, storage), num)
 
     @staticmethod
-    def get_current_page(library: LibraryModel, file: FileModel, storage: StorageService = None):
+    async def migrate_pages_manifests():
+        """Move the pages manifests stored in the files documents by previous versions to the pages collections,
+        failures are logged without preventing the app to start"""
+        try:
+            for library in await db_find_all_libraries():
+                if migrated := await db_migrate_file_pages(library["name"]):
+                    LOGGER.info(f"Moved the pages manifests of {migrated} files of library {library['name']}")
+        except PyMongoError as e:
+            LOGGER.error(f"Impossible to migrate the pages manifests : {e}")
+
+    @staticmethod
+    async def load_pages(library: LibraryModel, file: FileModel) -> FileModel:
+        """Load the pages manifest of a file in place if needed, the listings and metadata queries don't load it"""
+        if file.pages_names is None:
+            pages = await db_find_file_pages(library.name, str(file.id))
+            file.pages_names = pages["pages_names"]
+            file.pages_offsets = [PageOffsetModel(**offset) for offset in pages["pages_offsets"]] \
+                if pages.get("pages_offsets") is not None else None
+        return file
+
+    @staticmethod
+    async def open_page(library: LibraryModel, file: FileModel, num: int,
+                        storage: StorageService = None) -> Tuple[BinaryIO, int]:
+        """Open a page as a stream with its size to send it without holding it in memory, cached pages are served from
+        memory and the small pages are read to be cached. The stream must be closed once read, `iter_stream` does
+        it"""
+        await PrefetchService.wait_pending(file, num)
+        if (page := PageCache.get(file.md5, num)) is not None:
+            return io.BytesIO(page), len(page)
+        await FileService.load_pages(library, file)
+        if not storage:
+            storage = StorageService(library)
+        return await storage.run(FileService.__open_page, file, num, storage)
+
+    @staticmethod
+    def __open_page(file: FileModel, num: int, storage: StorageService) -> Tuple[BinaryIO, int]:
+        if (opened := storage.open_indexed_page(file, num)) is None:
+            opened = storage.open_page(file, FileService.get_opener_lib(file.full_path, storage), num)
+        stream, size = opened
+        if size > PageCache.MAX_PAGE_BYTES:
+            return opened
+        with stream:
+            page = stream.read()
+        PageCache.put(file.md5, num, page)
+        return io.BytesIO(page), len(page)
+
+    @staticmethod
+    async def iter_stream(library: LibraryModel, stream: BinaryIO, start: int = 0,
+                          length: int = None) -> AsyncIterator[bytes]:
+        """Read `length` bytes of a stream from `start` by chunks, the reads run in the library storage executor.
+        The stream is closed at the end"""
+        # In memory streams don't need to leave the event loop
+        async def run(func, *args):
+            if isinstance(stream, io.BytesIO):
+                return func(*args)
+            return await ExecutorService.run(library, func, *args)
+
+        try:
+            if start:
+                if stream.seekable():
+                    await run(stream.seek, start)
+                else:
+                    skipped = 0
+                    while skipped < start and (chunk := await run(stream.read, min(FileService.STREAM_CHUNK_SIZE,
+                                                                                     start - skipped))):
+                        skipped += len(chunk)
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = FileService.STREAM_CHUNK_SIZE if remaining is None else min(FileService.STREAM_CHUNK_SIZE,
+                                                                                     remaining)
+                if not (chunk := await run(stream.read, size)):
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            await run(stream.close)
+
+    @staticmethod
+    async def iter_pages(library: LibraryModel, file: FileModel, nums: List[int],
+                         storage: StorageService = None) -> AsyncIterator[Tuple[int, bytes]]:
+        """Read several pages of a file in order, the file is opened once and each page is read in the library storage
+        executor"""
+        if not storage:
+            storage = StorageService(library)
+        await FileService.load_pages(library, file)
+        pages = storage.iter_pages(file, nums, lambda: FileService.get_opener_lib(file.full_path, storage))
+        read = None
+        try:
+            # Shielded so a cancelled iteration can still wait for the read running in the executor
+            while (item := await asyncio.shield(read := asyncio.ensure_future(storage.run(next, pages, None)))) \
+                    is not None:
+                yield item
+        finally:
+            if read is not None and not read.done():
+                # The generator can't be closed while it is executing
+                await asyncio.wait({read})
+            await storage.run(pages.close)
+
+    @staticmethod
+    async def get_current_page(library: LibraryModel, file: FileModel, storage: StorageService = None) -> bytes:
         """Return file data corresponding to the current page number"""
-        return FileService.get_page(library, file, file.current_page, storage)
+        return await FileService.get_page(library, file, file.current_page, storage)
 
     @staticmethod
-    async def set_page(library: LibraryModel, file: FileModel, num: int) -> FileModel:
-        """Set the current page of a file in the database and return the updated FileModel object"""
+    async def set_page(library: LibraryModel, file: FileModel, num: int, prefetch: bool = True) -> FileModel:
+        """Set the current page of a file through the progress buffer and return the updated FileModel object, the
+        next pages in the reading direction are prefetched unless `prefetch` is False"""
         if 0 <= num <= file.pages_count - 1:
-            return await db_update_file(library.name, str(file.id), UpdateFileModel(
-                **{"current_page": num, "update_date": datetime.now()}))
+            # Written by the progress buffer, MongoDB dates have a millisecond precision
+            now = datetime.now()
+            progress = {"current_page": num, "update_date": now.replace(microsecond=now.microsecond // 1000 * 1000)}
+            # The given file may be outdated, the directories counts move from the last known progress
+            if (previous_page := ProgressBuffer.current_page(library.name, str(file.id))) is None:
+                stored_page = await db_find_file_current_page(library.name, str(file.id))
+                # A concurrent page turn may have been buffered during the query
+                if (previous_page := ProgressBuffer.current_page(library.name, str(file.id))) is None:
+                    previous_page = file.current_page if stored_page is None else stored_page
+            ProgressBuffer.put(library.name, str(file.id), progress)
+            updated_file = file.copy(update=progress)
+            previous_status = file.copy(update={"current_page": previous_page}).reading_status()
+            if previous_status != (status := updated_file.reading_status()):
+                increments = {f"{previous_status}_count": -1, f"{status}_count": 1}
+                increments.pop("read_count", None)
+                await db_inc_directory_counts(library.name, updated_file.path, increments)
+            if prefetch:
+                PrefetchService.schedule(library, updated_file, num < file.current_page, FileService.__fetch_page)
+            return updated_file
         return file
 
     @staticmethod
@@ -151,16 +454,15 @@ class FileService:
         return await FileService.set_page(library, file, file.current_page - 1)
 
     @staticmethod
-    def generate_thumbnail_cover(library: LibraryModel, file: FileModel, storage: StorageService = None) -> Image:
-        """Generate a thumbnail cover for the given file"""
+    async def generate_thumbnail_cover(library: LibraryModel, file: FileModel,
+                                       storage: StorageService = None) -> bytes | None:
+        """Generate the JPEG thumbnail cover of the given file, the image work is done in the process pool"""
         LOGGER.debug(f"Generating thumbnail cover for {file.full_path}")
+        if not storage:
+            storage = StorageService(library)
         try:
-            cover_bytes = FileService.get_page(library, file, 0, storage)
-            cover = Image.open(io.BytesIO(cover_bytes))
-            cover.thumbnail((400, 400))
-            if cover.mode in ("RGBA", "P"):
-                cover = cover.convert("RGB")
-            return cover
+            cover_bytes = await FileService.get_page(library, file, 0, storage)
+            return await ExecutorService.run_cpu(ImageService.thumbnail, cover_bytes)
         except UnidentifiedImageError:
             LOGGER.error(f"Cannot identify cover image while generating thumbnail for {file.full_path}")
 
@@ -0,0 +1,47 @@
+import io
+import logging
+
+from PIL import Image
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ImageService:
+    """CPU bound image work, run in the process pool so it can be given bytes and must return bytes"""
+    THUMBNAIL_SIZE = 400
+    # To increase when the thumbnails rendering changes, it's part of the covers ETag
+    THUMBNAIL_VERSION = 1
+
+    @staticmethod
+    def thumbnail(cover_bytes: bytes) -> bytes:
+        """Resize a cover to a JPEG thumbnail, JPEG covers are decoded directly at a reduced scale"""
+        cover = Image.open(io.BytesIO(cover_bytes))
+        cover.draft("RGB", (ImageService.THUMBNAIL_SIZE, ImageService.THUMBNAIL_SIZE))
+        cover.thumbnail((ImageService.THUMBNAIL_SIZE, ImageService.THUMBNAIL_SIZE))
+        if cover.mode not in ("RGB", "L"):
+            cover = cover.convert("RGB")
+        with io.BytesIO() as thumbnail_io:
+            cover.save(thumbnail_io, "JPEG")
+            return thumbnail_io.getvalue()
+
+    @staticmethod
+    def rendition(page_bytes: bytes, width: int | None, quality: int, image_format: str) -> bytes:
+        """Re-encode a page in the given format, pages wider than the given width are scaled down to it"""
+        page = Image.open(io.BytesIO(page_bytes))
+        if width and page.width > width:
+            height = max(round(page.height * width / page.width), 1)
+            page.draft("RGB", (width, height))
+            page = page.resize((width, height), Image.LANCZOS)
+        if image_format == "jpeg" and page.mode not in ("RGB", "L"):
+            page = page.convert("RGB")
+        elif page.mode not in ("RGB", "RGBA", "L", "LA"):
+            page = page.convert("RGBA" if "transparency" in page.info else "RGB")
+        with io.BytesIO() as rendition_io:
+            match image_format:
+                case "jpeg":
+                    page.save(rendition_io, "JPEG", quality=quality, optimize=True)
+                case "webp":
+                    page.save(rendition_io, "WEBP", quality=quality, method=4)
+                case _:
+                    page.save(rendition_io, image_format.upper())
+            return rendition_io.getvalue()
@@ -0,0 +1,99 @@
+import logging
+from typing import Dict, List
+
+import pymongo
+from pymongo import IndexModel
+from pymongo.errors import PyMongoError
+
+from app.services.db_service import db_find_all_libraries, db_create_indexes, db_index_information, \
+    db_index_stats, directories_collection
+
+LOGGER = logging.getLogger(__name__)
+
+
+class IndexService:
+    """Create and check the indexes backing the queries made on the collections of every library"""
+    FILE_INDEXES = [
+        IndexModel([("full_path", pymongo.ASCENDING)], name="full_path", unique=True),
+        IndexModel([("md5", pymongo.ASCENDING)], name="md5"),
+        IndexModel([("fingerprint", pymongo.ASCENDING)], name="fingerprint"),
+        # Directory content sorted by name and anchored prefix searches of sub-dirs
+        IndexModel([("path", pymongo.ASCENDING), ("name", pymongo.ASCENDING)], name="path_name"),
+        IndexModel([("add_date", pymongo.DESCENDING)], name="add_date"),
+        IndexModel([("update_date", pymongo.DESCENDING)], name="update_date"),
+        # Only the files being read are worth indexing for the last ongoing query
+        IndexModel([("update_date", pymongo.DESCENDING), ("current_page", pymongo.ASCENDING)], name="ongoing",
+                   partialFilterExpression={"current_page": {"$gt": 0}}),
+    ]
+    DIRECTORY_INDEXES = [
+        IndexModel([("path", pymongo.ASCENDING)], name="path", unique=True),
+        IndexModel([("parent", pymongo.ASCENDING)], name="parent"),
+    ]
+
+    @classmethod
+    def collections_indexes(cls, library_name: str) -> Dict[str, List[IndexModel]]:
+        """Expected indexes by collection name for a library"""
+        return {
+            library_name: cls.FILE_INDEXES,
+            directories_collection(library_name): cls.DIRECTORY_INDEXES
+        }
+
+    @classmethod
+    async def ensure_library_indexes(cls, library_name: str) -> Dict[str, List[str]]:
+        """Create the missing indexes of a library collections and return the names of the indexes that couldn't
+        be created (duplicated values on a unique index, conflicting options...) by collection"""
+        failures = {}
+        for collection_name, indexes in cls.collections_indexes(library_name).items():
+            existing = await db_index_information(collection_name)
+            missing = [index for index in indexes if index.document["name"] not in existing]
+            if not missing:
+                LOGGER.debug(f"Indexes of collection {collection_name} are up to date")
+                continue
+            try:
+                created = await db_create_indexes(collection_name, missing)
+                LOGGER.info(f"Created indexes {created} on collection {collection_name}")
+            except PyMongoError:
+                # Create them one by one to know which index is failing
+                for index in missing:
+                    try:
+                        await db_create_indexes(collection_name, [index])
+                    except PyMongoError as e:
+                        LOGGER.error(f"Impossible to create index {index.document['name']} on collection "
+                                     f"{collection_name} : {e}")
+                        failures.setdefault(collection_name, []).append(index.document["name"])
+        return failures
+
+    @classmethod
+    async def ensure_all_indexes(cls):
+        """Create the missing indexes of every library, failures are logged without preventing the app to start"""
+        try:
+            for library in await db_find_all_libraries():
+                await cls.ensure_library_indexes(library["name"])
+        except PyMongoError as e:
+            LOGGER.error(f"Impossible to check the libraries indexes : {e}")
+
+    @classmethod
+    async def library_index_stats(cls, library_name: str) -> Dict[str, List[dict]]:
+        """Usage counters of the indexes of a library collections, expected indexes that don't exist are reported as
+        missing"""
+        stats = {}
+        for collection_name, indexes in cls.collections_indexes(library_name).items():
+            existing = await db_index_information(collection_name)
+            try:
+                usages = {usage["name"]: usage for usage in await db_index_stats(collection_name)}
+            except PyMongoError as e:
+                LOGGER.warning(f"Impossible to get index stats of collection {collection_name} : {e}")
+                usages = {}
+            expected = [index.document["name"] for index in indexes]
+            stats[collection_name] = [
+                {
+                    "name": name,
+                    "key": dict(existing[name]["key"]) if name in existing else None,
+                    "expected": name in expected,
+                    "missing": name not in existing,
+                    "ops": usages[name]["accesses"]["ops"] if name in usages else None,
+                    "since": usages[name]["accesses"]["since"] if name in usages else None
+                }
+                for name in list(existing) + [name for name in expected if name not in existing]
+            ]
+        return stats
@@ -0,0 +1,62 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+from app.model.library_model import LibraryModel
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LibraryCache:
+    """Process wide cache of the libraries by name and by id. Libraries almost never change so every write
+    invalidates the whole cache, the TTL only covers changes made by another process"""
+    TTL_SECONDS = int(os.getenv("LIBRARY_CACHE_SECONDS", 60))
+
+    __by_name: Dict[str, Tuple[LibraryModel, float]] = {}
+    __by_id: Dict[str, Tuple[LibraryModel, float]] = {}
+    __lock = threading.Lock()
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def get_by_name(cls, name: str) -> LibraryModel | None:
+        return cls.__get(cls.__by_name, name)
+
+    @classmethod
+    def get_by_id(cls, object_id: str) -> LibraryModel | None:
+        return cls.__get(cls.__by_id, object_id)
+
+    @classmethod
+    def put(cls, library: LibraryModel):
+        expiration = time.monotonic() + cls.TTL_SECONDS
+        with cls.__lock:
+            cls.__by_name[library.name] = (library, expiration)
+            cls.__by_id[str(library.id)] = (library, expiration)
+
+    @classmethod
+    def clear(cls):
+        with cls.__lock:
+            cls.__by_name.clear()
+            cls.__by_id.clear()
+        LOGGER.debug("Library cache cleared")
+
+    @classmethod
+    def __get(cls, libraries: Dict[str, Tuple[LibraryModel, float]], key: str) -> LibraryModel | None:
+        with cls.__lock:
+            library, expiration = libraries.get(key, (None, 0))
+            if library is not None and expiration > time.monotonic():
+                cls.hits += 1
+                # Callers get their own copy so the cached library can't be altered
+                return library.copy()
+            cls.misses += 1
+            return None
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "libraries": len(cls.__by_name),
+            "hits": cls.hits,
+            "misses": cls.misses
+        }
@@ -0,0 +1,81 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Set, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PageCache:
+    """Process wide LRU cache of pages content keyed by file md5 and page number, bounded by the total size of the
+    cached pages rather than by their count"""
+    MAX_BYTES = int(os.getenv("PAGE_CACHE_MB", 256)) * 1024 * 1024
+    # Larger pages aren't cached so a single one can't evict most of the cache, they're streamed to the clients
+    MAX_PAGE_BYTES = MAX_BYTES // 16
+
+    __pages: OrderedDict[Tuple[str, int], bytes] = OrderedDict()
+    __pages_by_md5: Dict[str, Set[int]] = {}
+    __size = 0
+    __lock = threading.Lock()
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    @classmethod
+    def get(cls, md5: str, num: int) -> bytes | None:
+        with cls.__lock:
+            if (page := cls.__pages.get((md5, num))) is not None:
+                cls.__pages.move_to_end((md5, num))
+                cls.hits += 1
+                return page
+            cls.misses += 1
+            return None
+
+    @classmethod
+    def contains(cls, md5: str, num: int) -> bool:
+        """Check if a page is cached without counting a hit or a miss"""
+        with cls.__lock:
+            return (md5, num) in cls.__pages
+
+    @classmethod
+    def put(cls, md5: str, num: int, page: bytes):
+        if len(page) > cls.MAX_PAGE_BYTES:
+            return
+        with cls.__lock:
+            if (previous := cls.__pages.pop((md5, num), None)) is not None:
+                cls.__size -= len(previous)
+            cls.__pages[(md5, num)] = page
+            cls.__pages_by_md5.setdefault(md5, set()).add(num)
+            cls.__size += len(page)
+            while cls.__size > cls.MAX_BYTES:
+                (evicted_md5, evicted_num), evicted_page = cls.__pages.popitem(last=False)
+                cls.__forget(evicted_md5, evicted_num, evicted_page)
+                cls.evictions += 1
+
+    @classmethod
+    def invalidate(cls, md5: str):
+        """Remove every cached page of a file"""
+        with cls.__lock:
+            for num in list(cls.__pages_by_md5.get(md5, ())):
+                cls.__forget(md5, num, cls.__pages.pop((md5, num)))
+        LOGGER.debug(f"Page cache invalidated for md5 {md5}")
+
+    @classmethod
+    def __forget(cls, md5: str, num: int, page: bytes):
+        cls.__size -= len(page)
+        nums = cls.__pages_by_md5[md5]
+        nums.discard(num)
+        if not nums:
+            del cls.__pages_by_md5[md5]
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "pages": len(cls.__pages),
+            "size": cls.__size,
+            "max_size": cls.MAX_BYTES,
+            "hits": cls.hits,
+            "misses": cls.misses,
+            "evictions": cls.evictions
+        }
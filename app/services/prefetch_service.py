@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict
+
+from app.model.file_model import FileModel
+from app.model.library_model import LibraryModel
+from app.services.page_cache_service import PageCache
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PrefetchService:
+    """Warm the pages a reader is about to turn to into the page cache while the current one is being read"""
+    PAGES = int(os.getenv("PREFETCH_PAGES", 3))
+    MAX_PER_LIBRARY = int(os.getenv("PREFETCH_MAX_PER_LIBRARY", 2))
+
+    # Running prefetch tasks by file id then page number
+    __tasks: Dict[str, Dict[int, asyncio.Task]] = {}
+    __semaphores: Dict[str, asyncio.Semaphore] = {}
+    prefetched = 0
+    cancelled = 0
+
+    @classmethod
+    def schedule(cls, library: LibraryModel, file: FileModel, backward: bool,
+                 fetch: Callable[[LibraryModel, FileModel, int], Awaitable[bytes]]):
+        """Prefetch the pages following the current page of the file in the reading direction, prefetches of pages
+        outside this new window are cancelled as the reader jumped elsewhere"""
+        step = -1 if backward else 1
+        window = [num for num in (file.current_page + step * i for i in range(1, cls.PAGES + 1))
+                  if 0 <= num < file.pages_count]
+        tasks = cls.__tasks.setdefault(str(file.id), {})
+        for num in [num for num in tasks if num not in window]:
+            tasks.pop(num).cancel()
+            cls.cancelled += 1
+        for num in window:
+            if num not in tasks and not PageCache.contains(file.md5, num):
+                task = asyncio.create_task(cls.__prefetch(library, file, num, fetch))
+                task.add_done_callback(lambda done, page=num: cls.__forget(str(file.id), page, done))
+                tasks[num] = task
+        if not tasks:
+            del cls.__tasks[str(file.id)]
+
+    @classmethod
+    async def wait_pending(cls, file: FileModel, num: int):
+        """Wait for a running prefetch of a page to avoid reading it twice"""
+        if (task := cls.__tasks.get(str(file.id), {}).get(num)) is None:
+            return
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Only swallow the cancellation of the prefetch itself, not the one of the waiting request
+            if not task.cancelled():
+                raise
+        except Exception:
+            pass
+
+    @classmethod
+    async def __prefetch(cls, library: LibraryModel, file: FileModel, num: int,
+                         fetch: Callable[[LibraryModel, FileModel, int], Awaitable[bytes]]):
+        async with cls.__get_semaphore(library.name):
+            LOGGER.debug(f"{file.full_path} : prefetching page {num}")
+            try:
+                await fetch(library, file, num)
+                cls.prefetched += 1
+            except Exception as e:
+                LOGGER.warning(f"{file.full_path} : prefetch of page {num} failed : {e}")
+
+    @classmethod
+    def __get_semaphore(cls, library_name: str) -> asyncio.Semaphore:
+        if (semaphore := cls.__semaphores.get(library_name)) is None:
+            semaphore = cls.__semaphores[library_name] = asyncio.Semaphore(cls.MAX_PER_LIBRARY)
+        return semaphore
+
+    @classmethod
+    def __forget(cls, file_id: str, num: int, task: asyncio.Task):
+        if (tasks := cls.__tasks.get(file_id)) is not None and tasks.get(num) is task:
+            del tasks[num]
+            if not tasks:
+                del cls.__tasks[file_id]
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "running": sum(len(tasks) for tasks in cls.__tasks.values()),
+            "prefetched": cls.prefetched,
+            "cancelled": cls.cancelled
+        }
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ProgressBuffer:
+    """Write-behind buffer of the reading progress, only the latest current page and update date of each file is
+    kept and written with a bulk operation per library every FLUSH_SECONDS and on shutdown. The files read from the
+    database are overlaid with their buffered progress so the page turns are visible before being written"""
+    FLUSH_SECONDS = float(os.getenv("PROGRESS_FLUSH_SECONDS", 2))
+
+    # Buffered progress by library name and file id
+    __pending: Dict[str, Dict[str, dict]] = {}
+    __task: asyncio.Task | None = None
+    buffered = 0
+    flushes = 0
+    flushed = 0
+
+    @classmethod
+    def put(cls, library_name: str, file_id: str, progress: dict):
+        cls.__pending.setdefault(library_name, {})[file_id] = progress
+        cls.buffered += 1
+
+    @classmethod
+    def apply(cls, library_name: str, file_dict: dict) -> dict:
+        """Overlay the buffered progress of a file on its database document"""
+        if (progress := cls.__pending.get(library_name, {}).get(str(file_dict["_id"]))) is not None:
+            file_dict.update(progress)
+        return file_dict
+
+    @classmethod
+    def current_page(cls, library_name: str, file_id: str) -> int | None:
+        """Buffered current page of a file, None if it has no pending progress"""
+        if (progress := cls.__pending.get(library_name, {}).get(file_id)) is not None:
+            return progress["current_page"]
+        return None
+
+    @classmethod
+    def discard(cls, library_name: str, file_id: str):
+        """Drop the buffered progress of a file, used when its progress is written directly"""
+        cls.__pending.get(library_name, {}).pop(file_id, None)
+
+    @classmethod
+    def snapshot(cls, library_name: str = None) -> Dict[str, Dict[str, dict]]:
+        """Copy of the buffered progress to write, of all the libraries by default. The progress stays visible to the
+        reads until it is acknowledged"""
+        names = [library_name] if library_name is not None else list(cls.__pending)
+        return {name: dict(cls.__pending[name]) for name in names if cls.__pending.get(name)}
+
+    @classmethod
+    def acknowledge(cls, library_name: str, progress: Dict[str, dict]):
+        """Remove the written progress, unless the file got a newer one during the write"""
+        pending = cls.__pending.get(library_name, {})
+        for file_id, file_progress in progress.items():
+            if pending.get(file_id) is file_progress:
+                del pending[file_id]
+        if not pending:
+            cls.__pending.pop(library_name, None)
+        cls.flushes += 1
+        cls.flushed += len(progress)
+
+    @classmethod
+    def start(cls, flush: Callable[[], Awaitable]):
+        """Start writing the buffer periodically with `flush`"""
+        if cls.__task is None or cls.__task.done():
+            cls.__task = asyncio.create_task(cls.__run(flush))
+
+    @classmethod
+    async def __run(cls, flush: Callable[[], Awaitable]):
+        while True:
+            await asyncio.sleep(cls.FLUSH_SECONDS)
+            try:
+                await flush()
+            except Exception as e:
+                LOGGER.exception(f"Reading progress flush failed : {e}", exc_info=e)
+
+    @classmethod
+    def stop(cls):
+        if cls.__task is not None:
+            cls.__task.cancel()
+            cls.__task = None
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "pending": sum(len(progress) for progress in cls.__pending.values()),
+            "buffered": cls.buffered,
+            "flushes": cls.flushes,
+            "flushed": cls.flushed
+        }
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+import struct
+from contextlib import aclosing
+
+from fastapi import status
+from fastapi.websockets import WebSocket
+
+from app.model.file_model import FileModel, ResponseFileModel
+from app.model.library_model import LibraryModel
+from app.services.batch_service import BatchService
+from app.services.file_service import FileService
+from app.services.storage_service import StorageService
+
+LOGGER = logging.getLogger(__name__)
+
+# Page index prefixed to the pushed pages, unsigned 32 bits big endian
+PAGE_HEADER = struct.Struct(">I")
+
+
+class PushSession:
+    """Push mode of the reading websocket, the pages are sent ahead of the reader as binary frames made of the page
+    index followed by the page bytes. Each pushed page uses a credit granted by the client so a slow reader is never
+    flooded, consecutive pages are read from a single opening of the file.
+
+    The client messages are JSON objects with any of the keys:
+        credits : number of additional pages the client can receive
+        read : page the reader is on, saved as the current page and answered with the file as JSON
+        seek : push the pages from this page instead of continuing where the push is"""
+    CREDITS = int(os.getenv("PUSH_CREDITS", 4))
+
+    sessions = 0
+    sessions_total = 0
+    pages_pushed = 0
+
+    def __init__(self, websocket: WebSocket, library: LibraryModel, file: FileModel, resume: int | None = None,
+                 credits: int | None = None):
+        self.websocket = websocket
+        self.library = library
+        self.file = file
+        self.__storage = StorageService(library)
+        self.__next = self.__clamp(file.current_page if resume is None else resume)
+        self.__credits = self.CREDITS if credits is None else max(credits, 0)
+        # Incremented on each seek to drop the pages being read for the previous position
+        self.__position = 0
+        self.__wake = asyncio.Event()
+        self.__wake.set()
+
+    def __clamp(self, num: int) -> int:
+        return min(max(num, 0), self.file.pages_count)
+
+    async def run(self):
+        """Push the pages until the client disconnects"""
+        PushSession.sessions += 1
+        PushSession.sessions_total += 1
+        pusher = receiver = None
+        try:
+            await self.websocket.send_json(ResponseFileModel(**self.file.dict()).json())
+            pusher = asyncio.create_task(self.__push())
+            receiver = asyncio.create_task(self.__receive())
+            await asyncio.wait({pusher, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if pusher.done() and not pusher.cancelled() and (error := pusher.exception()) is not None:
+                LOGGER.exception(f"{self.file.full_path} : pages push failed : {error}", exc_info=error)
+                await self.websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+                return
+            # The client disconnected or sent an invalid message
+            await receiver
+        finally:
+            PushSession.sessions -= 1
+            tasks = [task for task in (pusher, receiver) if task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __receive(self):
+        while True:
+            message = await self.websocket.receive_json()
+            if "seek" in message:
+                self.__next = self.__clamp(int(message["seek"]))
+                self.__position += 1
+            if "credits" in message:
+                self.__credits += max(int(message["credits"]), 0)
+            self.__wake.set()
+            if "read" in message:
+                # The pages already pushed don't need to be prefetched
+                self.file = await FileService.set_page(self.library, self.file, int(message["read"]), prefetch=False)
+                await self.websocket.send_json(ResponseFileModel(**self.file.dict()).json())
+
+    async def __push(self):
+        while True:
+            await self.__wake.wait()
+            self.__wake.clear()
+            while self.__credits > 0 and self.__next < self.file.pages_count:
+                position = self.__position
+                nums = list(range(self.__next, min(self.__next + self.__credits, self.file.pages_count,
+                                                   self.__next + BatchService.MAX_PAGES)))
+                async with aclosing(FileService.iter_pages(self.library, self.file, nums, self.__storage)) as pages:
+                    async for num, page in pages:
+                        if position != self.__position:
+                            break
+                        await self.websocket.send_bytes(PAGE_HEADER.pack(num) + page)
+                        PushSession.pages_pushed += 1
+                        self.__credits -= 1
+                        if position != self.__position:
+                            break
+                        self.__next = num + 1
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {"sessions": cls.sessions, "sessions_total": cls.sessions_total, "pages_pushed": cls.pages_pushed}
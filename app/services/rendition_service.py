@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from os.path import join
+
+from app.model.file_model import FileModel
+from app.model.library_model import LibraryModel
+from app.model.rendition_model import RenditionModel
+from app.services.executor_service import ExecutorService
+from app.services.file_service import FileService
+from app.services.image_service import ImageService
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RenditionCache:
+    """Size capped on-disk LRU cache of the pages renditions. The recency is kept in the files modification time so
+    the cache survives restarts."""
+    DIRECTORY = os.getenv("RENDITION_CACHE_DIR", join(tempfile.gettempdir(), "comic-back", "renditions"))
+    MAX_BYTES = int(os.getenv("RENDITION_CACHE_MB", 1024)) * 1024 * 1024
+
+    __entries: OrderedDict[str, int] | None = None
+    __size = 0
+    __lock = threading.Lock()
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    @classmethod
+    def get(cls, name: str) -> bytes | None:
+        with cls.__lock:
+            if name not in cls.__get_entries():
+                cls.misses += 1
+                return None
+            cls.__entries.move_to_end(name)
+        try:
+            path = join(cls.DIRECTORY, name)
+            with open(path, "rb") as rendition:
+                content = rendition.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with cls.__lock:
+                if (size := cls.__entries.pop(name, None)) is not None:
+                    cls.__size -= size
+                cls.misses += 1
+            return None
+        with cls.__lock:
+            cls.hits += 1
+        return content
+
+    @classmethod
+    def put(cls, name: str, content: bytes):
+        if len(content) > cls.MAX_BYTES:
+            return
+        os.makedirs(cls.DIRECTORY, exist_ok=True)
+        # Written aside then renamed so a rendition is never read half written
+        with tempfile.NamedTemporaryFile(dir=cls.DIRECTORY, prefix=".", delete=False) as rendition:
+            rendition.write(content)
+        os.replace(rendition.name, join(cls.DIRECTORY, name))
+        evicted = []
+        with cls.__lock:
+            entries = cls.__get_entries()
+            cls.__size += len(content) - entries.pop(name, 0)
+            entries[name] = len(content)
+            while cls.__size > cls.MAX_BYTES:
+                evicted_name, evicted_size = entries.popitem(last=False)
+                cls.__size -= evicted_size
+                evicted.append(evicted_name)
+            cls.evictions += len(evicted)
+        for evicted_name in evicted:
+            try:
+                os.remove(join(cls.DIRECTORY, evicted_name))
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def __get_entries(cls) -> OrderedDict[str, int]:
+        """Load the renditions already on disk, least recently used first"""
+        if cls.__entries is None:
+            cls.__entries = OrderedDict()
+            if os.path.isdir(cls.DIRECTORY):
+                files = [entry for entry in os.scandir(cls.DIRECTORY)
+                         if entry.is_file() and not entry.name.startswith(".")]
+                for entry in sorted(files, key=lambda file: file.stat().st_mtime):
+                    cls.__entries[entry.name] = entry.stat().st_size
+                    cls.__size += entry.stat().st_size
+                LOGGER.info(f"Loaded {len(cls.__entries)} renditions from cache directory {cls.DIRECTORY}")
+        return cls.__entries
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls.__lock:
+            return {
+                "renditions": len(cls.__entries or ()),
+                "size": cls.__size,
+                "max_size": cls.MAX_BYTES,
+                "hits": cls.hits,
+                "misses": cls.misses,
+                "evictions": cls.evictions
+            }
+
+
+class RenditionService:
+    @staticmethod
+    async def get_page(library: LibraryModel, file: FileModel, num: int, rendition: RenditionModel) -> bytes:
+        """Get a page resized and re-encoded according to a resolved rendition, renditions are rendered in the image
+        process pool and kept in the renditions cache"""
+        name = rendition.cache_name(file.md5, num)
+        if (content := await RenditionService.__run_disk(RenditionCache.get, name)) is not None:
+            return content
+        page = await FileService.get_page(library, file, num)
+        content = await ExecutorService.run_cpu(ImageService.rendition, page, rendition.width, rendition.quality,
+                                                rendition.format.value)
+        await RenditionService.__run_disk(RenditionCache.put, name, content)
+        LOGGER.debug(f"{file.full_path} : rendered page {num} as {name}, {len(page)} to {len(content)} bytes")
+        return content
+
+    @staticmethod
+    async def __run_disk(func, *args):
+        # The cache is on the local disk whatever the library storage is
+        return await asyncio.get_running_loop().run_in_executor(ExecutorService.get_executor("local"), func, *args)
@@ -0,0 +1,120 @@
+import io
+import logging
+import threading
+from collections import OrderedDict
+
+from smb.SMBConnection import SMBConnection
+
+from app.services.smb_pool import SmbConnectionPool
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SmbFile(io.RawIOBase):
+    """Read only seekable file object over an SMB file, only the ranges actually read are transferred.
+    Small reads are served by blocks kept in a small LRU cache (archive headers are read in tiny pieces) while large
+    reads are transferred in one request and bypass the cache."""
+    BLOCK_SIZE = 64 * 1024
+    CACHED_BLOCKS = 16
+
+    # Process wide counters
+    __stats_lock = threading.Lock()
+    __total_bytes_transferred = 0
+    __total_requests = 0
+    __total_opened_files = 0
+
+    def __init__(self, pool: SmbConnectionPool, service_name: str, path: str):
+        super().__init__()
+        self.pool = pool
+        self.service_name = service_name
+        self.path = path
+        self.size = pool.run(lambda conn: conn.getAttributes(service_name=service_name, path=path).file_size)
+        self.position = 0
+        self.bytes_transferred = 0
+        self.requests = 0
+        self.__blocks: OrderedDict[int, bytes] = OrderedDict()
+        with SmbFile.__stats_lock:
+            SmbFile.__total_opened_files += 1
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Process wide transfer counters"""
+        return {
+            "opened_files": cls.__total_opened_files,
+            "requests": cls.__total_requests,
+            "bytes_transferred": cls.__total_bytes_transferred
+        }
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_SET:
+                position = offset
+            case io.SEEK_CUR:
+                position = self.position + offset
+            case io.SEEK_END:
+                position = self.size + offset
+            case _:
+                raise ValueError(f"Invalid whence value: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self.size - self.position)
+        if size <= 0:
+            return 0
+        data = self.__read_range(self.position, size)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            LOGGER.debug(f"{self.path} : transferred {self.bytes_transferred} bytes of {self.size} "
+                         f"in {self.requests} requests")
+            self.__blocks.clear()
+        super().close()
+
+    def __read_range(self, offset: int, size: int) -> bytes:
+        if size >= self.BLOCK_SIZE:
+            return self.__transfer(offset, size)
+        first_block = offset // self.BLOCK_SIZE
+        last_block = (offset + size - 1) // self.BLOCK_SIZE
+        data = b"".join(self.__get_block(index) for index in range(first_block, last_block + 1))
+        start = offset - first_block * self.BLOCK_SIZE
+        return data[start:start + size]
+
+    def __get_block(self, index: int) -> bytes:
+        if (block := self.__blocks.get(index)) is not None:
+            self.__blocks.move_to_end(index)
+            return block
+        block = self.__transfer(index * self.BLOCK_SIZE, self.BLOCK_SIZE)
+        self.__blocks[index] = block
+        if len(self.__blocks) > self.CACHED_BLOCKS:
+            self.__blocks.popitem(last=False)
+        return block
+
+    def __retrieve(self, conn: SMBConnection, offset: int, size: int) -> bytes:
+        with io.BytesIO() as file_io:
+            conn.retrieveFileFromOffset(service_name=self.service_name, path=self.path, file_obj=file_io,
+                                        offset=offset, max_length=size)
+            return file_io.getvalue()
+
+    def __transfer(self, offset: int, size: int) -> bytes:
+        data = self.pool.run(lambda conn: self.__retrieve(conn, offset, size))
+        self.requests += 1
+        self.bytes_transferred += len(data)
+        with SmbFile.__stats_lock:
+            SmbFile.__total_requests += 1
+            SmbFile.__total_bytes_transferred += len(data)
+        return data
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple, TypeVar
+
+from smb.SMBConnection import SMBConnection
+from smb.base import NotConnectedError, SMBTimeout
+from smb.smb_structs import OperationFailure
+
+from app.model.library_model import LibraryModel
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Errors leaving a connection closed or out of sync with the server, it can't be used anymore
+CONNECTION_ERRORS = (NotConnectedError, SMBTimeout, OSError)
+
+
+class SmbConnectionPool:
+    """Bounded pool of authenticated SMB connections shared by every request made on the same library"""
+    POOL_SIZE = int(os.getenv("SMB_POOL_SIZE", 4))
+    IDLE_SECONDS = int(os.getenv("SMB_POOL_IDLE_SECONDS", 300))
+    # Connections unused for longer than this are checked with an echo before being handed out
+    CHECK_SECONDS = 30
+    ACQUIRE_TIMEOUT = 60
+
+    __pools: Dict[str, "SmbConnectionPool"] = {}
+    __pools_lock = threading.Lock()
+    __reaper: asyncio.Task | None = None
+
+    def __init__(self, library: LibraryModel):
+        self.library = library
+        self.signature = SmbConnectionPool.__signature(library)
+        self.__slots = threading.BoundedSemaphore(self.POOL_SIZE)
+        self.__idle: List[Tuple[SMBConnection, float]] = []
+        self.__lock = threading.Lock()
+        self.__closed = False
+        self.created_connections = 0
+        self.reconnections = 0
+
+    @staticmethod
+    def __signature(library: LibraryModel) -> tuple:
+        return library.server, library.service_name, library.user, library.password
+
+    @classmethod
+    def get(cls, library: LibraryModel) -> "SmbConnectionPool":
+        """Get the pool of a library, the pool is rebuilt if the library connection info changed"""
+        with cls.__pools_lock:
+            pool = cls.__pools.get(library.name)
+            if pool is None or pool.signature != cls.__signature(library):
+                if pool is not None:
+                    LOGGER.info(f"SMB connection info changed for library {library.name}, rebuilding pool")
+                    pool.close()
+                pool = cls.__pools[library.name] = SmbConnectionPool(library)
+            return pool
+
+    @classmethod
+    def invalidate(cls, library_name: str):
+        """Close and forget the pool of a library"""
+        with cls.__pools_lock:
+            if (pool := cls.__pools.pop(library_name, None)) is not None:
+                LOGGER.info(f"Closing SMB connection pool of library {library_name}")
+                pool.close()
+
+    @classmethod
+    def close_all(cls):
+        with cls.__pools_lock:
+            for pool in cls.__pools.values():
+                pool.close()
+            cls.__pools.clear()
+
+    @classmethod
+    def start_reaper(cls):
+        """Start closing the expired idle connections of every pool periodically, so the connections of a library
+        that isn't used anymore are closed too"""
+        if cls.__reaper is None or cls.__reaper.done():
+            cls.__reaper = asyncio.create_task(cls.__reap())
+
+    @classmethod
+    async def __reap(cls):
+        while True:
+            await asyncio.sleep(max(cls.IDLE_SECONDS / 2, 1))
+            with cls.__pools_lock:
+                pools = list(cls.__pools.values())
+            for pool in pools:
+                try:
+                    # Closing a connection may block on the socket
+                    await asyncio.to_thread(pool.__close_expired)
+                except Exception as e:
+                    LOGGER.exception(f"Closing idle SMB connections of library {pool.library.name} failed : {e}",
+                                     exc_info=e)
+
+    @classmethod
+    def stop_reaper(cls):
+        if cls.__reaper is not None:
+            cls.__reaper.cancel()
+            cls.__reaper = None
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls.__pools_lock:
+            return {name: {"idle": len(pool.__idle), "created": pool.created_connections,
+                           "reconnections": pool.reconnections} for name, pool in cls.__pools.items()}
+
+    def run(self, action: Callable[[SMBConnection], T]) -> T:
+        """Run an action with a pooled connection, the action is retried once on a new connection if the first one
+        turns out to be broken"""
+        for attempt in (1, 2):
+            with self.connection() as conn:
+                try:
+                    return action(conn)
+                except CONNECTION_ERRORS:
+                    self.__discard(conn)
+                    if attempt == 2:
+                        raise
+                except OperationFailure:
+                    # Also raised for legit errors (missing file...), only retry if the connection itself is broken
+                    if attempt == 2 or self.__is_alive(conn):
+                        raise
+                    self.__discard(conn)
+            self.reconnections += 1
+            LOGGER.warning(f"SMB connection to {self.library.server} lost, reconnecting")
+
+    @contextmanager
+    def connection(self) -> Iterator[SMBConnection]:
+        """Borrow a connection from the pool, waiting for one to be available if the pool is exhausted. The connection
+        is closed instead of given back if it breaks while borrowed"""
+        if not self.__slots.acquire(timeout=self.ACQUIRE_TIMEOUT):
+            raise TimeoutError(f"No SMB connection available for library {self.library.name}")
+        try:
+            conn = self.__take()
+            try:
+                yield conn
+            except CONNECTION_ERRORS:
+                self.__discard(conn)
+                raise
+            finally:
+                self.__give_back(conn)
+        finally:
+            self.__slots.release()
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            idle, self.__idle = self.__idle, []
+        for conn, _ in idle:
+            self.__close_conn(conn)
+
+    def __take(self) -> SMBConnection:
+        self.__close_expired()
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                conn, last_used = self.__idle.pop()
+            if time.monotonic() - last_used < self.CHECK_SECONDS or self.__is_alive(conn):
+                return conn
+            self.__close_conn(conn)
+        return self.__connect()
+
+    def __give_back(self, conn: SMBConnection):
+        if getattr(conn, "pool_discarded", False):
+            return
+        with self.__lock:
+            if not self.__closed:
+                self.__idle.append((conn, time.monotonic()))
+                conn = None
+        if conn is not None:
+            self.__close_conn(conn)
+        self.__close_expired()
+
+    def __discard(self, conn: SMBConnection):
+        conn.pool_discarded = True
+        self.__close_conn(conn)
+
+    def __close_expired(self):
+        limit = time.monotonic() - self.IDLE_SECONDS
+        with self.__lock:
+            expired = [conn for conn, last_used in self.__idle if last_used < limit]
+            self.__idle = [(conn, last_used) for conn, last_used in self.__idle if last_used >= limit]
+        for conn in expired:
+            LOGGER.debug(f"Closing idle SMB connection to {self.library.server}")
+            self.__close_conn(conn)
+
+    def __connect(self) -> SMBConnection:
+        conn = SMBConnection(**self.library.smb_conn_info())
+        if not conn.connect(self.library.server, 445):
+            raise NotConnectedError(f"SMB authentication failed on {self.library.server}")
+        self.created_connections += 1
+        LOGGER.debug(f"Opened SMB connection to {self.library.server} for library {self.library.name}")
+        return conn
+
+    @staticmethod
+    def __is_alive(conn: SMBConnection) -> bool:
+        try:
+            conn.echo(b"comic-back", timeout=5)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def __close_conn(conn: SMBConnection):
+        try:
+            conn.close()
+        except Exception as e:
+            LOGGER.debug(f"Error while closing SMB connection : {e}")
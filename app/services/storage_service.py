@@ -1,19 +1,38 @@
+import hashlib
 import importlib
+import logging
 from abc import ABC, abstractmethod
-from typing import List, Type, Tuple
+from typing import List, Type, Tuple, BinaryIO, Callable, TypeVar, NamedTuple, Iterator, Set
 from zipfile import ZipFile
 
-from PIL.Image import Image
 from rarfile import RarFile
 from smb.base import SharedFile
 from starlette.responses import Response
 
-from app.model.file_model import FileModel
+from app.model.file_model import FileModel, PageOffsetModel
 from app.model.library_model import LibraryModel
+from app.services.archive_service import ArchiveService
+from app.services.executor_service import ExecutorService
+from app.services.thumbnail_manifest_service import ThumbnailManifest
+
+LOGGER = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class StorageEntry(NamedTuple):
+    """Item of a directory listing"""
+    name: str
+    is_dir: bool
+    size: int
+    mtime: float
 
 
 # class StorageService(ABC):
 class StorageService:
+    HASH_CHUNK_SIZE = 1024 * 1024
+    FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
     def __init__(self, library: LibraryModel):
         """Replace this class by a children class according to library connect_type"""
         module = importlib.import_module("app.services.storage_service_" + library.connect_type)
@@ -22,13 +41,37 @@ class StorageService:
         self.thumbnail_folder = f"{self.library.path}/.comic-back/thumbnails"
 
     def get_thumbnail_path(self, file: FileModel) -> str:
-        return f"{self.thumbnail_folder}/{file.id}.jpg"
+        return self.get_thumbnail_path_by_id(str(file.id))
+
+    def get_thumbnail_path_by_id(self, file_id: str) -> str:
+        return f"{self.thumbnail_folder}/{file_id}.jpg"
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Await a blocking storage call, executed in the thread pool of the library backend type"""
+        return await ExecutorService.run(self.library, func, *args, **kwargs)
 
     # Files methods
-    # @abstractmethod
     def calculate_md5(self, file_path: str) -> str:
-        """Calculate md5 signature of a file"""
-        pass
+        """Calculate md5 signature of a file, reading it by chunks to keep the memory usage flat"""
+        hasher = hashlib.md5()
+        with self.open_file(file_path) as file_io:
+            while chunk := file_io.read(self.HASH_CHUNK_SIZE):
+                hasher.update(chunk)
+        LOGGER.debug(f"{file_path} : md5 is {hasher.hexdigest()}")
+        return hasher.hexdigest()
+
+    def calculate_fingerprint(self, file_path: str) -> str:
+        """Calculate a quick signature of a file from its size and the hash of its first and last blocks, used to
+        recognize moved files without reading them entirely"""
+        hasher = hashlib.md5()
+        with self.open_file(file_path) as file_io:
+            size = file_io.seek(0, 2)
+            file_io.seek(0)
+            hasher.update(file_io.read(self.FINGERPRINT_BLOCK_SIZE))
+            if size > self.FINGERPRINT_BLOCK_SIZE:
+                file_io.seek(max(self.FINGERPRINT_BLOCK_SIZE, size - self.FINGERPRINT_BLOCK_SIZE))
+                hasher.update(file_io.read(self.FINGERPRINT_BLOCK_SIZE))
+        return f"{size}-{hasher.hexdigest()}"
 
     def get_opener_lib(self, file_path: str) -> Type[ZipFile | RarFile] | None:
         """Test the file directly to see which library can open it"""
@@ -39,6 +82,78 @@ class StorageService:
         """Create a sorted list of all the pages names in their naming order and count the result"""
         pass
 
+    # @abstractmethod
+    def index_pages(self, file_path: str, opener_lib: Type[ZipFile | RarFile]
+                    ) -> Tuple[List[str], List[PageOffsetModel] | None]:
+        """Create a sorted list of all the pages names and their byte location in the archive when available"""
+        pass
+
+    # @abstractmethod
+    def stat(self, file_path: str) -> Tuple[int, float]:
+        """Get the size and the modification time of a file"""
+        pass
+
+    # @abstractmethod
+    def open_file(self, file_path: str) -> BinaryIO:
+        """Open a file in binary read mode"""
+        pass
+
+    def __has_usable_index(self, file: FileModel) -> bool:
+        if not file.pages_offsets or file.size is None:
+            return False
+        if self.stat(file.full_path) != (file.size, file.mtime):
+            LOGGER.debug(f"{file.full_path} : changed since indexing, ignoring pages index")
+            return False
+        return True
+
+    def get_indexed_page(self, file: FileModel, num: int) -> bytes | None:
+        """Read a page directly from its byte location in the archive, return None if the file has no usable index"""
+        if not self.__has_usable_index(file):
+            return None
+        with self.open_file(file.full_path) as file_io:
+            return ArchiveService.read_indexed_page(file_io, file.pages_offsets[num])
+
+    def open_indexed_page(self, file: FileModel, num: int) -> Tuple[BinaryIO, int] | None:
+        """Open a page directly from its byte location in the archive as a stream with its size, return None if the
+        file has no usable index"""
+        if not self.__has_usable_index(file):
+            return None
+        file_io = self.open_file(file.full_path)
+        if (stream := ArchiveService.open_indexed_page(file_io, file.pages_offsets[num], file.pages_names[num])) is None:
+            file_io.close()
+            return None
+        return stream, file.pages_offsets[num].file_size
+
+    def iter_pages(self, file: FileModel, nums: List[int],
+                   get_opener_lib: Callable[[], Type[ZipFile | RarFile]]) -> Iterator[Tuple[int, bytes]]:
+        """Read several pages in the given order opening the file only once, the pages index is used while it matches
+        the archive otherwise the archive is opened with the lib returned by `get_opener_lib`"""
+        with self.open_file(file.full_path) as file_io:
+            indexed = self.__has_usable_index(file)
+            archive = None
+            try:
+                for num in nums:
+                    page = ArchiveService.read_indexed_page(file_io, file.pages_offsets[num]) if indexed else None
+                    if page is None:
+                        if archive is None:
+                            indexed = False
+                            archive = get_opener_lib()(file_io, 'r')
+                        page = archive.read(file.pages_names[num])
+                    yield num, page
+            finally:
+                if archive is not None:
+                    archive.close()
+
+    def open_page(self, file: FileModel, opener_lib: Type[ZipFile | RarFile], num: int = 0) -> Tuple[BinaryIO, int]:
+        """Open a page as a stream of its decompressed content with its size, the archive stays open until the stream
+        is closed"""
+        file_io = self.open_file(file.full_path)
+        try:
+            return ArchiveService.open_member(file_io, opener_lib(file_io, 'r'), file.pages_names[num])
+        except Exception:
+            file_io.close()
+            raise
+
     # @abstractmethod
     def get_page(self, file: FileModel, opener_lib: Type[ZipFile | RarFile], num: int = 0) -> bytes:
         """Get a specific page with a given number"""
@@ -51,9 +166,21 @@ class StorageService:
         pass
 
     # @abstractmethod
+    def list_dir(self, path: str) -> List[StorageEntry]:
+        """List the items of a directory with their size and modification time"""
+        pass
+
+    def list_file_names(self, path: str) -> Set[str]:
+        """Names of the files of a directory, empty if the directory doesn't exist"""
+        try:
+            return {entry.name for entry in self.list_dir(path) if not entry.is_dir}
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+
     async def get_dir_content(self, path: str) -> Tuple[List[str], List[str]]:
         """Return the content of a directory in two lists, the list of sub-dirs and the list of supported files"""
-        pass
+        entries = await self.run(self.list_dir, path)
+        return [entry.name for entry in entries if entry.is_dir], [entry.name for entry in entries if not entry.is_dir]
 
     # Thumbnails methods
     # @abstractmethod
@@ -62,16 +189,25 @@ class StorageService:
         pass
 
     # @abstractmethod
-    def save_thumbnail(self, file: FileModel, thumbnail: Image):
-        """Save a thumbnail image in the library storage"""
+    def save_thumbnail(self, file: FileModel, thumbnail: bytes):
+        """Save a JPEG thumbnail in the library storage"""
         pass
 
-    # @abstractmethod
     def thumbnail_exist(self, file: FileModel) -> bool:
-        """Check if a thumbnail exist for the given file"""
+        """Check if a thumbnail exist for the given file, answered by the thumbnails manifest of the library"""
+        return ThumbnailManifest.contains(self.library.name, str(file.id), self.list_thumbnails)
+
+    # @abstractmethod
+    def list_thumbnails(self) -> List[str]:
+        """List the ids of the files having a thumbnail"""
         pass
 
     # @abstractmethod
     def delete_thumbnail(self, file: FileModel):
         """Delete the thumbnail for the given file"""
         pass
+
+    # @abstractmethod
+    def delete_thumbnails(self, file_ids: List[str]):
+        """Delete the thumbnails of several files at once, the files without thumbnail are skipped"""
+        pass
@@ -1,30 +1,23 @@
-import hashlib
 import logging
-import pathlib
-from os import remove, listdir
+from os import listdir, remove, scandir, stat
 from os.path import join, isfile
-from typing import List, Type, Tuple
+from typing import List, Type, Tuple, BinaryIO
 from zipfile import ZipFile, BadZipFile
 from rarfile import RarFile, NotRarFile, BadRarFile
 from pathlib import Path
 
-from PIL.Image import Image
 from smb.base import SharedFile
 from fastapi.responses import FileResponse
 
-from app.model.file_model import FileModel
-from app.services.storage_service import StorageService
-from app.tools import is_image
+from app.model.file_model import FileModel, PageOffsetModel
+from app.services.archive_service import ArchiveService
+from app.services.storage_service import StorageService, StorageEntry
+from app.services.thumbnail_manifest_service import ThumbnailManifest
 
 LOGGER = logging.getLogger(__name__)
 
 
 class StorageServiceLocal(StorageService):
-    def calculate_md5(self, file_path: str) -> str:
-        md5 = hashlib.md5(pathlib.Path(join(self.library.path, file_path)).read_bytes()).hexdigest()
-        LOGGER.debug(f"{file_path} : md5 is {md5}")
-        return md5
-
     def get_opener_lib(self, file_path: str) -> Type[ZipFile | RarFile] | None:
         # Test if file a zip
         try:
@@ -41,15 +34,22 @@ class StorageServiceLocal(StorageService):
         LOGGER.error(f"No opener lib found for {file_path}")
 
     def list_pages(self, file_path: str, opener_lib: Type[ZipFile | RarFile]) -> List[str]:
+        return self.index_pages(file_path, opener_lib)[0]
+
+    def index_pages(self, file_path: str, opener_lib: Type[ZipFile | RarFile]
+                    ) -> Tuple[List[str], List[PageOffsetModel] | None]:
         LOGGER.debug(f"{file_path} : Counting pages")
-        pages_names = []
         with opener_lib(join(self.library.path, file_path), 'r') as file:
-            for item in file.infolist():
-                if is_image(item.filename):
-                    pages_names.append(item.filename)
+            pages_names, pages_offsets = ArchiveService.index_pages(file)
             LOGGER.debug(f"{file_path} : {len(pages_names)} pages")
-            pages_names.sort()
-            return pages_names
+            return pages_names, pages_offsets
+
+    def stat(self, file_path: str) -> Tuple[int, float]:
+        file_stat = stat(join(self.library.path, file_path))
+        return file_stat.st_size, file_stat.st_mtime
+
+    def open_file(self, file_path: str) -> BinaryIO:
+        return open(join(self.library.path, file_path), 'rb')
 
     def get_page(self, file: FileModel, opener_lib: Type[ZipFile | RarFile], num: int = 0) -> bytes:
         LOGGER.debug(f"{file.full_path} : getting page {num}")
@@ -63,29 +63,54 @@ class StorageServiceLocal(StorageService):
     def isfile(self, file: str | SharedFile) -> bool:
         return isfile(join(self.library.path, file))
 
-    async def get_dir_content(self, path: str) -> Tuple[List[str], List[str]]:
-        dirs = []
-        files = []
-        for item in listdir(join(self.library.path, path)):
-            files.append(item) if isfile(join(self.library.path, join(path, item))) else dirs.append(item)
-        return dirs, files
+    def list_dir(self, path: str) -> List[StorageEntry]:
+        entries = []
+        with scandir(join(self.library.path, path)) as items:
+            for item in items:
+                try:
+                    item_stat = item.stat()
+                except OSError:
+                    LOGGER.warning(f"Can't read {join(path, item.name)}, ignoring it")
+                    continue
+                entries.append(StorageEntry(item.name, not item.is_file(), item_stat.st_size, item_stat.st_mtime))
+        return entries
 
     def get_thumbnail(self, file: FileModel) -> FileResponse:
         """Get the thumbnail image of a file in a ready to send file response object"""
         return FileResponse(self.get_thumbnail_path(file))
 
-    def save_thumbnail(self, file: FileModel, thumbnail: Image):
+    def save_thumbnail(self, file: FileModel, thumbnail: bytes):
         try:
             Path(self.thumbnail_folder).mkdir(parents=True, exist_ok=True)
-            thumbnail.save(self.get_thumbnail_path(file))
+            Path(self.get_thumbnail_path(file)).write_bytes(thumbnail)
+            ThumbnailManifest.add(self.library.name, str(file.id))
             LOGGER.info(f"Generated thumbnail for {file.id} {file.path}")
         except Exception as e:
             LOGGER.exception(f"Can't save thumbnail for {file.id} {file.full_path} : {e}", exc_info=e)
 
-    def thumbnail_exist(self, file: FileModel) -> bool:
-        return self.isfile(join(self.library.path, self.get_thumbnail_path(file)))
+    def list_thumbnails(self) -> List[str]:
+        try:
+            return [Path(name).stem for name in listdir(self.thumbnail_folder) if name.endswith(".jpg")]
+        except FileNotFoundError:
+            return []
 
     def delete_thumbnail(self, file: FileModel):
         if self.thumbnail_exist(file):
-            remove(self.get_thumbnail_path(file))
-            LOGGER.info(f"Removed thumbnail for {file.id}")
+            try:
+                remove(self.get_thumbnail_path(file))
+                LOGGER.info(f"Removed thumbnail for {file.id}")
+            except FileNotFoundError:
+                pass
+            ThumbnailManifest.discard(self.library.name, str(file.id))
+
+    def delete_thumbnails(self, file_ids: List[str]):
+        removed = 0
+        for file_id in file_ids:
+            if ThumbnailManifest.contains(self.library.name, file_id, self.list_thumbnails):
+                try:
+                    remove(self.get_thumbnail_path_by_id(file_id))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                ThumbnailManifest.discard(self.library.name, file_id)
+        LOGGER.info(f"Removed {removed} thumbnails of library {self.library.name}")
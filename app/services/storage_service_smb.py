@@ -1,34 +1,35 @@
-import hashlib
 import logging
 import os.path
 from io import BytesIO
 from os.path import join
-from typing import Type, List, Tuple
+from typing import Type, List, Tuple, Callable, TypeVar, Set
 from zipfile import ZipFile, BadZipFile
 
-from PIL.Image import Image
 from rarfile import RarFile, NotRarFile, BadRarFile
 from smb.SMBConnection import SMBConnection
 from smb.base import SharedFile
 from smb.smb_structs import OperationFailure
 from starlette.responses import Response
 
-from app.model.file_model import FileModel
-from app.services.storage_service import StorageService
-from app.tools import is_image
+from app.model.file_model import FileModel, PageOffsetModel
+from app.services.archive_service import ArchiveService
+from app.services.smb_file import SmbFile
+from app.services.smb_pool import SmbConnectionPool
+from app.services.storage_service import StorageService, StorageEntry
+from app.services.thumbnail_manifest_service import ThumbnailManifest
 
 LOGGER = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 class StorageServiceSmb(StorageService):
-    __con: SMBConnection = None
+    def __get_pool(self) -> SmbConnectionPool:
+        return SmbConnectionPool.get(self.library)
 
-    def __get_smb_conn(self) -> SMBConnection:
-        if self.__con is None:
-            conn = SMBConnection(**self.library.smb_conn_info())
-            conn.connect(self.library.server, 445)
-            self.__con = conn
-        return self.__con
+    def __run(self, action: Callable[[SMBConnection], T]) -> T:
+        """Run an action with a connection borrowed from the library pool"""
+        return self.__get_pool().run(action)
 
     def __ensure_directory_exist(self, conn: SMBConnection, path: str):
         try:
@@ -41,62 +42,56 @@ class StorageServiceSmb(StorageService):
             return True
         return False
 
-    def calculate_md5(self, file_path: str) -> str:
-        with BytesIO() as file_io:
-            conn = self.__get_smb_conn()
-            conn.retrieveFile(service_name=self.library.service_name, path=join(self.library.path, file_path), file_obj=file_io)
-            file_io.seek(0)
-            hasher = hashlib.md5()
-            while True:
-                chunk = file_io.read(8192)
-                if not chunk:
-                    break
-                hasher.update(chunk)
-            LOGGER.debug(f"{file_path} : md5 is {hasher.hexdigest()}")
-            return hasher.hexdigest()
+    def __retrieve_file(self, conn: SMBConnection, path: str, file_io: BytesIO):
+        # Reset the buffer first in case of retry after a partial transfer
+        file_io.seek(0)
+        file_io.truncate()
+        conn.retrieveFile(service_name=self.library.service_name, path=path, file_obj=file_io)
+
+    def __store_file(self, conn: SMBConnection, path: str, file_io: BytesIO):
+        file_io.seek(0)
+        conn.storeFile(service_name=self.library.service_name, path=path, file_obj=file_io)
 
     def get_opener_lib(self, file_path: str) -> Type[ZipFile | RarFile] | None:
-        conn = self.__get_smb_conn()
-        with BytesIO() as file_io:
-            conn.retrieveFile(service_name=self.library.service_name, path=join(self.library.path, file_path), file_obj=file_io)
-            file_io.seek(0)
+        with self.open_file(file_path) as file_io:
             # Test if file a zip
             try:
-                with ZipFile(join(self.library.path, file_path), 'r'):
+                with ZipFile(file_io, 'r'):
                     return ZipFile
             except BadZipFile:
                 pass
             # Test if file is a rar
             try:
-                with RarFile(join(self.library.path, file_path), 'r'):
+                file_io.seek(0)
+                with RarFile(file_io, 'r'):
                     return RarFile
             except (NotRarFile, BadRarFile):
                 pass
         LOGGER.error(f"No opener lib found for {file_path}")
 
     def list_pages(self, file_path: str, opener_lib: Type[ZipFile | RarFile]) -> List[str]:
+        return self.index_pages(file_path, opener_lib)[0]
+
+    def index_pages(self, file_path: str, opener_lib: Type[ZipFile | RarFile]
+                    ) -> Tuple[List[str], List[PageOffsetModel] | None]:
         LOGGER.debug(f"{file_path} : Counting pages")
-        pages_names = []
-        conn = self.__get_smb_conn()
-        with BytesIO() as file_io:
-            conn.retrieveFile(service_name=self.library.service_name, path=join(self.library.path, file_path), file_obj=file_io)
-            file_io.seek(0)
-            # Open the file from the BytesIO object
+        with self.open_file(file_path) as file_io:
             with opener_lib(file_io, 'r') as file:
-                for item in file.infolist():
-                    if is_image(item.filename):
-                        pages_names.append(item.filename)
+                pages_names, pages_offsets = ArchiveService.index_pages(file)
                 LOGGER.debug(f"{file_path} : {len(pages_names)} pages")
-                pages_names.sort()
-                return pages_names
+                return pages_names, pages_offsets
+
+    def stat(self, file_path: str) -> Tuple[int, float]:
+        attributes = self.__run(lambda conn: conn.getAttributes(service_name=self.library.service_name,
+                                                                path=join(self.library.path, file_path)))
+        return attributes.file_size, attributes.last_write_time
+
+    def open_file(self, file_path: str) -> SmbFile:
+        return SmbFile(self.__get_pool(), self.library.service_name, join(self.library.path, file_path))
 
     def get_page(self, file: FileModel, opener_lib: Type[ZipFile | RarFile], num: int = 0) -> bytes:
         LOGGER.debug(f"{file.full_path} : getting page {num}")
-        conn = self.__get_smb_conn()
-        with BytesIO() as file_io:
-            conn.retrieveFile(service_name=self.library.service_name, path=join(self.library.path, file.full_path), file_obj=file_io)
-            file_io.seek(0)
-            # Open the file from the BytesIO object
+        with self.open_file(file.full_path) as file_io:
             with opener_lib(file_io, 'r') as storage_file:
                 try:
                     with storage_file.open(file.pages_names[num]) as img:
@@ -108,51 +103,102 @@ class StorageServiceSmb(StorageService):
         if type(file) == SharedFile:
             return not file.isDirectory
         parent_dir, file_name = os.path.split(file)
-        conn = self.__get_smb_conn()
-        files_list = conn.listPath(service_name=self.library.service_name, path=join(self.library.path, parent_dir))
+        files_list = self.__run(lambda conn: conn.listPath(service_name=self.library.service_name,
+                                                           path=join(self.library.path, parent_dir)))
         return any((not listed_file.isDirectory) and listed_file.filename == file_name for listed_file in files_list)
 
-    async def get_dir_content(self, path: str) -> Tuple[List[str], List[str]]:
-        dirs = []
-        files = []
-        conn = self.__get_smb_conn()
-        for item in conn.listPath(service_name=self.library.service_name, path=join(self.library.path, path)):
-            files.append(item.filename) if not item.isDirectory else dirs.append(item.filename)
-        return dirs, files
+    def list_dir(self, path: str) -> List[StorageEntry]:
+        items = self.__run(lambda conn: conn.listPath(service_name=self.library.service_name,
+                                                      path=join(self.library.path, path)))
+        return [StorageEntry(item.filename, item.isDirectory, item.file_size, item.last_write_time) for item in items]
+
+    def list_file_names(self, path: str) -> Set[str]:
+        try:
+            return super().list_file_names(path)
+        except OperationFailure:
+            # Also raised for other errors, an unreadable directory mustn't be taken for a deleted one
+            if path and not self.__directory_exist(path):
+                return set()
+            raise
+
+    def __directory_exist(self, path: str) -> bool:
+        parent_dir, dir_name = os.path.split(path)
+        try:
+            entries = self.list_dir(parent_dir)
+        except OperationFailure:
+            if parent_dir and not self.__directory_exist(parent_dir):
+                return False
+            raise
+        return any(entry.is_dir and entry.name == dir_name for entry in entries)
 
     def get_thumbnail(self, file: FileModel) -> Response:
         """Get the thumbnail image of a file in a ready to send file response object"""
-        conn = self.__get_smb_conn()
         with BytesIO() as file_io:
-            conn.retrieveFile(service_name=self.library.service_name, path=self.get_thumbnail_path(file),
-                              file_obj=file_io)
-            file_io.seek(0)
-            content = file_io.read()
+            self.__run(lambda conn: self.__retrieve_file(conn, self.get_thumbnail_path(file), file_io))
+            content = file_io.getvalue()
             return Response(content=content, media_type="image/jpeg",
                             headers={"Content-Length": str(len(content)), "Content-Encoding": "binary"})
 
-    def save_thumbnail(self, file: FileModel, thumbnail: Image):
-        conn = self.__get_smb_conn()
-        img_io = BytesIO()
+    def save_thumbnail(self, file: FileModel, thumbnail: bytes):
+        img_io = BytesIO(thumbnail)
         try:
-            self.__ensure_directory_exist(conn, self.thumbnail_folder)
-            thumbnail.save(img_io, "JPEG")
-            img_io.seek(0)
-            conn.storeFile(service_name=self.library.service_name,
-                           path=self.get_thumbnail_path(file),
-                           file_obj=img_io)
+            try:
+                self.__run(lambda conn: self.__store_file(conn, self.get_thumbnail_path(file), img_io))
+            except OperationFailure:
+                # The thumbnails folder is only checked when the store fails to avoid listing it for every thumbnail
+                self.__run(lambda conn: self.__ensure_directory_exist(conn, self.thumbnail_folder))
+                self.__run(lambda conn: self.__store_file(conn, self.get_thumbnail_path(file), img_io))
+            ThumbnailManifest.add(self.library.name, str(file.id))
             LOGGER.info(f"Saved thumbnail for {file.id} {file.full_path}")
         except Exception as e:
             LOGGER.exception(f"Can't save thumbnail for {file.id} {file.full_path} : {e}", exc_info=e)
 
-    def thumbnail_exist(self, file: FileModel) -> bool:
-        conn = self.__get_smb_conn()
-        self.__ensure_directory_exist(conn, self.thumbnail_folder)
-        thumbnails = conn.listPath(service_name=self.library.service_name, path=self.thumbnail_folder)
-        return any(thumbnail.filename == f"{file.id}.jpg" for thumbnail in thumbnails)
+    def list_thumbnails(self) -> List[str]:
+        try:
+            thumbnails = self.__run(lambda conn: conn.listPath(service_name=self.library.service_name,
+                                                               path=self.thumbnail_folder, pattern="*.jpg"))
+        except OperationFailure:
+            self.__run(lambda conn: self.__ensure_directory_exist(conn, self.thumbnail_folder))
+            return []
+        return [os.path.splitext(thumbnail.filename)[0] for thumbnail in thumbnails if not thumbnail.isDirectory]
 
     def delete_thumbnail(self, file: FileModel):
         if self.thumbnail_exist(file):
-            conn = self.__get_smb_conn()
-            conn.deleteFiles(self.library.service_name, self.get_thumbnail_path(file))
+            self.__run(lambda conn: conn.deleteFiles(self.library.service_name, self.get_thumbnail_path(file)))
+            ThumbnailManifest.discard(self.library.name, str(file.id))
             LOGGER.info(f"Removed thumbnail for {file.id}")
+
+    def delete_thumbnails(self, file_ids: List[str]):
+        thumbnails = [file_id for file_id in file_ids
+                      if ThumbnailManifest.contains(self.library.name, file_id, self.list_thumbnails)]
+        if not thumbnails:
+            return
+
+        # Only the thumbnails left are deleted again when the batch is retried on a new connection
+        pending = list(thumbnails)
+        failed = []
+
+        def delete(conn: SMBConnection):
+            # A single connection for the whole batch
+            while pending:
+                file_id = pending[0]
+                try:
+                    conn.deleteFiles(self.library.service_name, self.get_thumbnail_path_by_id(file_id))
+                except OperationFailure:
+                    # Also raised for a thumbnail already deleted, it only failed if the thumbnail is still there
+                    try:
+                        conn.getAttributes(self.library.service_name, self.get_thumbnail_path_by_id(file_id))
+                        failed.append(file_id)
+                    except OperationFailure:
+                        pass
+                ThumbnailManifest.discard(self.library.name, file_id)
+                pending.pop(0)
+
+        try:
+            self.__run(delete)
+        except Exception as e:
+            LOGGER.error(f"Thumbnails removal interrupted in library {self.library.name}, {len(pending)} left : {e}")
+        if failed:
+            LOGGER.error(f"Failed to remove the thumbnails of files {', '.join(failed)} of library {self.library.name}")
+        LOGGER.info(f"Removed {len(thumbnails) - len(pending) - len(failed)} thumbnails of library "
+                    f"{self.library.name}")
@@ -0,0 +1,65 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Set, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ThumbnailManifest:
+    """Process wide set of the file ids having a thumbnail in each library, loaded with a single listing of the
+    thumbnails folder and kept up to date by the thumbnails saves and deletions. The TTL only covers thumbnails
+    changed by another process"""
+    TTL_SECONDS = int(os.getenv("THUMBNAIL_MANIFEST_SECONDS", 600))
+
+    __manifests: Dict[str, Tuple[Set[str], float]] = {}
+    __loading_locks: Dict[str, threading.Lock] = {}
+    __lock = threading.Lock()
+    loads = 0
+
+    @classmethod
+    def contains(cls, library_name: str, file_id: str, load: Callable[[], Iterable[str]]) -> bool:
+        """Check if a file has a thumbnail, the manifest of the library is (re)loaded with `load` when needed"""
+        with cls.__lock:
+            ids, expiration = cls.__manifests.get(library_name, (None, 0))
+            if ids is not None and expiration > time.monotonic():
+                return file_id in ids
+            loading_lock = cls.__loading_locks.setdefault(library_name, threading.Lock())
+        # Only one thread lists the thumbnails folder, the others wait for its result
+        with loading_lock:
+            with cls.__lock:
+                ids, expiration = cls.__manifests.get(library_name, (None, 0))
+            if ids is None or expiration <= time.monotonic():
+                ids = set(load())
+                with cls.__lock:
+                    cls.__manifests[library_name] = (ids, time.monotonic() + cls.TTL_SECONDS)
+                    cls.loads += 1
+                LOGGER.info(f"Loaded thumbnails manifest of library {library_name} : {len(ids)} thumbnails")
+        with cls.__lock:
+            return file_id in ids
+
+    @classmethod
+    def add(cls, library_name: str, file_id: str):
+        with cls.__lock:
+            if (manifest := cls.__manifests.get(library_name)) is not None:
+                manifest[0].add(file_id)
+
+    @classmethod
+    def discard(cls, library_name: str, file_id: str):
+        with cls.__lock:
+            if (manifest := cls.__manifests.get(library_name)) is not None:
+                manifest[0].discard(file_id)
+
+    @classmethod
+    def invalidate(cls, library_name: str):
+        with cls.__lock:
+            cls.__manifests.pop(library_name, None)
+
+    @classmethod
+    def stats(cls) -> dict:
+        with cls.__lock:
+            return {
+                "loads": cls.loads,
+                "thumbnails": {name: len(ids) for name, (ids, _) in cls.__manifests.items()}
+            }
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import time
+from typing import List, Set, Tuple
+
+from app.model.file_model import FileModel
+from app.model.library_model import LibraryModel
+from app.services.db_service import db_find_file, db_find_library_by_name
+from app.services.file_service import FileService
+from app.services.storage_service import StorageService
+
+LOGGER = logging.getLogger(__name__)
+
+PENDING = "pending"
+
+
+class ThumbnailService:
+    """Background queue generating the missing thumbnails, listings only enqueue the files and return right away.
+    The covers are read by the storage executors and resized in the image process pool."""
+    WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+    QUEUE_SIZE = int(os.getenv("THUMBNAIL_QUEUE_SIZE", 10000))
+
+    # Library name and file id of the files to generate, the files are read again when their turn comes
+    __queue: asyncio.Queue[Tuple[str, str]] | None = None
+    __workers: List[asyncio.Task] = []
+    # Queued or running jobs by library name and file id, to not generate the same thumbnail twice
+    __pending: Set[Tuple[str, str]] = set()
+    generated = 0
+    failed = 0
+    dropped = 0
+    busy_seconds = 0.0
+
+    @classmethod
+    def enqueue(cls, library: LibraryModel, file: FileModel):
+        """Queue the generation of the thumbnail of a file, the file is marked as pending. When the queue is full the
+        file is left to be queued again by a later listing"""
+        file.thumbnail_status = PENDING
+        if (key := (library.name, str(file.id))) in cls.__pending:
+            return
+        cls.__start()
+        try:
+            cls.__queue.put_nowait(key)
+        except asyncio.QueueFull:
+            cls.dropped += 1
+            return
+        cls.__pending.add(key)
+
+    @classmethod
+    def __start(cls):
+        if cls.__queue is None:
+            cls.__queue = asyncio.Queue(cls.QUEUE_SIZE)
+        cls.__workers = [worker for worker in cls.__workers if not worker.done()]
+        while len(cls.__workers) < cls.WORKERS:
+            cls.__workers.append(asyncio.create_task(cls.__work()))
+
+    @classmethod
+    async def __work(cls):
+        # The queue is replaced on shutdown while the cancelled workers finish
+        queue = cls.__queue
+        while True:
+            library_name, file_id = await queue.get()
+            start = time.monotonic()
+            try:
+                library = await db_find_library_by_name(library_name)
+                # Removed since it was queued
+                if library is None or (file := await db_find_file(library_name, file_id)) is None:
+                    continue
+                storage = StorageService(library)
+                # Might have been generated since the file was queued
+                if not await storage.run(storage.thumbnail_exist, file):
+                    thumbnail = await FileService.generate_thumbnail_cover(library, file, storage)
+                    if thumbnail:
+                        await storage.run(storage.save_thumbnail, file, thumbnail)
+                        cls.generated += 1
+                    else:
+                        cls.failed += 1
+            except Exception as e:
+                cls.failed += 1
+                LOGGER.exception(f"Thumbnail generation failed for file {file_id} of library {library_name} : {e}",
+                                 exc_info=e)
+            finally:
+                cls.busy_seconds += time.monotonic() - start
+                cls.__pending.discard((library_name, file_id))
+                queue.task_done()
+
+    @classmethod
+    async def shutdown(cls):
+        for worker in cls.__workers:
+            worker.cancel()
+        await asyncio.gather(*cls.__workers, return_exceptions=True)
+        cls.__workers = []
+        cls.__queue = None
+        cls.__pending.clear()
+
+    @classmethod
+    def stats(cls) -> dict:
+        processed = cls.generated + cls.failed
+        return {
+            "queue_depth": cls.__queue.qsize() if cls.__queue is not None else 0,
+            "pending": len(cls.__pending),
+            "workers": len([worker for worker in cls.__workers if not worker.done()]),
+            "generated": cls.generated,
+            "failed": cls.failed,
+            "dropped": cls.dropped,
+            "average_seconds": round(cls.busy_seconds / processed, 3) if processed else 0.0,
+            # Per worker busy time, the overall throughput scales with the number of workers
+            "per_second": round(processed / cls.busy_seconds * max(cls.WORKERS, 1), 2) if cls.busy_seconds else 0.0
+        }
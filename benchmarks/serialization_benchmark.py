@@ -0,0 +1,77 @@
+"""Compare the validated and the fast paths turning file documents into a JSON listing response.
+
+Run from the repository root: python -m benchmarks.serialization_benchmark [documents] [rounds]
+"""
+import asyncio
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List
+
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.endpoint.base_models.fast_json_response import FastJSONResponse
+from app.model.file_model import FileModel, ResponseFileModel
+
+
+def documents(count: int) -> List[dict]:
+    """Files documents as returned by the database driver"""
+    now = datetime.now()
+    return [{
+        "_id": ObjectId(),
+        "full_path": f"Series {i // 50}/Volume {i % 50:02d}.cbz",
+        "path": f"Series {i // 50}",
+        "name": f"Volume {i % 50:02d}",
+        "extension": ".cbz",
+        "type": "file",
+        "pages_count": 200,
+        "current_page": i % 200,
+        "md5": f"{i:032x}",
+        "fingerprint": f"{i:040x}",
+        "size": 50_000_000 + i,
+        "mtime": 1_700_000_000.0 + i,
+        "add_date": now - timedelta(minutes=i),
+        "update_date": now - timedelta(seconds=i)
+    } for i in range(count)]
+
+
+async def validated_path(docs: List[dict]) -> bytes:
+    """Validated models then the response model validation and encoding done by FastAPI"""
+    files = [FileModel(**doc) for doc in docs]
+    field = create_response_field(name="Response_files", type_=List[ResponseFileModel])
+    content = await serialize_response(field=field, response_content=files)
+    return JSONResponse(content).body
+
+
+async def fast_path(docs: List[dict]) -> bytes:
+    """Unvalidated models encoded by orjson"""
+    files = [FileModel.from_document(doc) for doc in docs]
+    return FastJSONResponse([ResponseFileModel.serialize(file) for file in files]).body
+
+
+def measure(name: str, path: Callable, docs: List[dict], rounds: int) -> float:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        body = asyncio.run(path(docs))
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"{name:<10} best {best * 1000:8.1f} ms  {len(docs) / best:10.0f} docs/s  {len(body) / 1024:8.0f} KB")
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    docs = documents(count)
+    print(f"{count} documents, best of {rounds} rounds")
+    validated = measure("validated", validated_path, docs, rounds)
+    fast = measure("fast", fast_path, docs, rounds)
+    print(f"speedup x{validated / fast:.1f}")
+
+
+if __name__ == "__main__":
+    main()